@@ -0,0 +1,228 @@
+import io
+import os
+import sys
+import json
+import time
+import wave
+import random
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+from collections import defaultdict
+
+import numpy as np
+import requests
+
+ROUTES = ("audio", "generate", "bpm")
+
+
+def silent_wav(seconds: float = 0.5, sample_rate: int = 16000) -> bytes:
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(b"\0\0" * int(seconds * sample_rate))
+    return buffer.getvalue()
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(port: int, workdir: str) -> subprocess.Popen:
+    """
+    Runs the API under uvicorn with the fake LLM, and stores under workdir,
+    unless the environment already says otherwise.
+    """
+    env = dict(os.environ)
+    env.setdefault("LLM_BACKEND", "fake")
+    env.setdefault("GEMINI_API_KEY", "fake")
+    env.setdefault("ANALYSIS_CACHE_PATH", os.path.join(workdir, "analysis_cache.db"))
+    env.setdefault("DIARY_DB_PATH", os.path.join(workdir, "diary.db"))
+    env.setdefault("HEART_RATE_DB_PATH", os.path.join(workdir, "heart_rate.db"))
+    env.setdefault("RENDER_CACHE_DIR", os.path.join(workdir, "render_cache"))
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env,
+    )
+    deadline = time.monotonic() + 120
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"Server exited with code {server.returncode}")
+        try:
+            requests.get(f"http://127.0.0.1:{port}/", timeout=1)
+            return server
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError("Server did not start in time")
+
+
+class LoadTest:
+    """
+    Drives the routes concurrently, concurrency clients per route, and keeps
+    the latency of every request finished after the warmup.
+    """
+
+    def __init__(self, url: str, routes, concurrency: int, duration: float, warmup: float,
+                 audio: bytes, bpm_range, backend: str = None):
+        self.url = url.rstrip("/")
+        self.routes = routes
+        self.concurrency = concurrency
+        self.duration = duration
+        self.warmup = warmup
+        self.audio = audio
+        self.bpm_range = bpm_range
+        self.backend = backend
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.error_samples = {}
+        self.counter = 0
+        self.lock = threading.Lock()
+
+    def request(self, session: requests.Session, route: str, client: str, rng: random.Random):
+        bpm = rng.uniform(*self.bpm_range)
+        if route == "audio":
+            with self.lock:
+                self.counter += 1
+                number = self.counter
+            # A unique trailer keeps every upload out of the analysis cache
+            data = self.audio + number.to_bytes(8, "little")
+            return session.post(
+                f"{self.url}/api/v1/audio",
+                files={"file": (f"note-{number}.wav", data, "audio/wav")},
+                data={"user_id": client},
+            )
+        if route == "generate":
+            body = {"bpm": bpm}
+            if self.backend:
+                body["backend"] = self.backend
+            return session.post(f"{self.url}/api/v1/generate", json=body)
+        return session.post(f"{self.url}/api/v1/bpm", json={"bpm": bpm, "user_id": client})
+
+    def client(self, route: str, index: int, started: float):
+        rng = random.Random(f"{route}-{index}")
+        client = f"load-{route}-{index}"
+        with requests.Session() as session:
+            while time.monotonic() < started + self.warmup + self.duration:
+                sent = time.monotonic()
+                try:
+                    response = self.request(session, route, client, rng)
+                    ok = response.ok
+                    error = f"{response.status_code} {response.text[:200]}"
+                except requests.RequestException as e:
+                    ok, error = False, repr(e)
+                done = time.monotonic()
+                if sent < started + self.warmup:
+                    continue
+                with self.lock:
+                    if ok:
+                        self.latencies[route].append(done - sent)
+                    else:
+                        self.errors[route] += 1
+                        self.error_samples.setdefault(route, error)
+
+    def run(self) -> dict:
+        started = time.monotonic()
+        threads = [
+            threading.Thread(target=self.client, args=(route, index, started), daemon=True)
+            for route in self.routes for index in range(self.concurrency)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - started - self.warmup
+        return {route: self.summary(route, elapsed) for route in self.routes}
+
+    def summary(self, route: str, elapsed: float) -> dict:
+        latencies = np.array(self.latencies[route]) * 1000
+        result = {
+            "requests": len(latencies),
+            "errors": self.errors[route],
+            "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed > 0 else 0.0,
+        }
+        if len(latencies):
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+            result.update({
+                "mean_ms": round(float(latencies.mean()), 2),
+                "p50_ms": round(float(p50), 2),
+                "p95_ms": round(float(p95), 2),
+                "p99_ms": round(float(p99), 2),
+                "max_ms": round(float(latencies.max()), 2),
+            })
+        if route in self.error_samples:
+            result["first_error"] = self.error_samples[route]
+        return result
+
+
+def print_report(results: dict):
+    columns = ("requests", "errors", "throughput_rps", "mean_ms", "p50_ms", "p95_ms", "p99_ms", "max_ms")
+    print(f"{'route':<10}" + "".join(f"{column:>16}" for column in columns))
+    for route, result in results.items():
+        print(f"{route:<10}" + "".join(f"{result.get(column, '-'):>16}" for column in columns))
+    for route, result in results.items():
+        if "first_error" in result:
+            print(f"{route} first error: {result['first_error']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Load test /audio, /generate and /bpm concurrently, by default against a local "
+                    "server started with the fake LLM (LLM_BACKEND=fake)"
+    )
+    parser.add_argument('--url', help="server to test instead of starting one")
+    parser.add_argument('--routes', default=",".join(ROUTES), help="comma separated routes to drive")
+    parser.add_argument('-c', '--concurrency', type=int, default=8, help="concurrent clients per route")
+    parser.add_argument('-d', '--duration', type=float, default=30, help="seconds measured")
+    parser.add_argument('--warmup', type=float, default=5, help="seconds run before measuring")
+    parser.add_argument('--audio-file', help="voice note to upload (default: half a second of silence)")
+    parser.add_argument('--bpm-range', default="50,120", help="range the requested BPMs are drawn from")
+    parser.add_argument('--backend', choices=("gemini", "procedural"), help="music backend asked from /generate")
+    parser.add_argument('--json', help="also write the results to this file, to compare runs")
+    args = parser.parse_args(argv)
+
+    routes = [route.strip() for route in args.routes.split(",") if route.strip()]
+    unknown = set(routes) - set(ROUTES)
+    if unknown:
+        parser.error(f"unknown routes {sorted(unknown)}, choose from {ROUTES}")
+    if args.audio_file:
+        with open(args.audio_file, "rb") as f:
+            audio = f.read()
+    else:
+        audio = silent_wav()
+    bpm_range = tuple(float(bpm) for bpm in args.bpm_range.split(","))
+
+    server = None
+    with tempfile.TemporaryDirectory(prefix="loadtest-") as workdir:
+        url = args.url
+        if url is None:
+            port = free_port()
+            server = start_server(port, workdir)
+            url = f"http://127.0.0.1:{port}"
+        try:
+            print(f"Load testing {url}: {', '.join(routes)} with {args.concurrency} clients each "
+                  f"for {args.duration:g}s after {args.warmup:g}s warmup")
+            results = LoadTest(url, routes, args.concurrency, args.duration, args.warmup,
+                               audio, bpm_range, args.backend).run()
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait(timeout=30)
+
+    print_report(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"url": url, "concurrency": args.concurrency, "duration": args.duration,
+                       "routes": results}, f, indent=2)
+    return 1 if any(result["errors"] for result in results.values()) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
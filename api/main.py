@@ -1,15 +1,29 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
-from routes import audio, music
+from routes import audio, diary, music, session
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    music.music_service.start_background_tasks()
+    audio.job_queue.start()
+    yield
+    await audio.job_queue.stop()
+    await music.music_service.stop_background_tasks()
+    audio.audio_service.heart_rate_store.flush()
+    audio.audio_service.cache.flush()
 
 app = FastAPI(
     title="Audio Processing API",
     description="API for handling audio files and music generation",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 app.include_router(audio.router, prefix="/api/v1", tags=["audio"])
 app.include_router(music.router, prefix="/api/v1", tags=["music"])
+app.include_router(session.router, prefix="/api/v1", tags=["session"])
+app.include_router(diary.router, prefix="/api/v1", tags=["diary"])
 
 @app.get("/")
 async def root():
-    return {"message": "Welcome to Audio BPM API"}
\ No newline at end of file
+    return {"message": "Welcome to Audio BPM API"}
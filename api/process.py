@@ -1,112 +1,553 @@
-from midiutil import MIDIFile
 import mido
+import io
+import os
+import sys
 import json
-from collections import defaultdict
+import time
+import struct
+import argparse
+import contextlib
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-def midi_to_text(midi_path, min_velocity=10):
-    """Convert MIDI to ultra-compact text representation with duration handling."""
-    mid = mido.MidiFile(midi_path)
-    song = {'q': mid.ticks_per_beat, 't': []}
-    global_events = []
-
-    # Process first track for global events
-    abs_time = 0
-    for msg in mid.tracks[0]:
-        abs_time += msg.time
-        if msg.type == 'set_tempo':
-            global_events.append(['t', abs_time, int(mido.tempo2bpm(msg.tempo))])
-        elif msg.type == 'time_signature':
-            global_events.append(['s', abs_time, msg.numerator, msg.denominator])
-    
-    if global_events:
-        song['g'] = global_events
+# One note per record: [delta, pitch, velocity, duration] plus the MIDI channel
+NOTE_DTYPE = np.dtype([
+    ('delta', '<i4'),
+    ('pitch', 'u1'),
+    ('velocity', 'u1'),
+    ('duration', '<i4'),
+    ('channel', 'u1'),
+])
 
-    # Process tracks
-    for track in mid.tracks:
-        notes = []
-        active = defaultdict(list)
-        abs_time = last = prog = 0
-        
-        for msg in track:
-            abs_time += msg.time
-            if msg.type == 'program_change':
-                prog = msg.program
-            elif msg.type in ('note_on', 'note_off') or (msg.type == 'note_on' and msg.velocity == 0):
-                vel = msg.velocity
-                if msg.type == 'note_off' or (msg.type == 'note_on' and vel < min_velocity):
-                    # Find and close matching note
-                    if active[msg.channel]:
-                        note = next((n for n in reversed(active[msg.channel]) if n['note'] == msg.note), None)
-                        if note:
-                            active[msg.channel].remove(note)
-                            delta = note['start'] - last
-                            entry = [delta, msg.note, note['vel'], abs_time - note['start']]
-                            if msg.channel: entry.append(msg.channel)
-                            notes.append(entry)
-                            last = note['start']
-                elif msg.type == 'note_on':
-                    # Record as potential note start
-                    active[msg.channel].append({
-                        'note': msg.note,
-                        'start': abs_time,
-                        'vel': vel
-                    })
-
-        # Add remaining active notes (handle hanging notes)
-        for chan in active:
-            for note in active[chan]:
-                delta = note['start'] - last
-                entry = [delta, note['note'], note['vel'], 0]  # 0 duration for hanging notes
-                if chan: entry.append(chan)
+def _read_vlq(data, pos):
+    value = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value = (value << 7) | (byte & 0x7F)
+        if byte < 0x80:
+            return value, pos
+
+def _iter_track_events(data):
+    """
+    Decode raw MTrk bytes lazily, yielding (abs_time, type, channel, a, b) for the
+    events midi_to_text needs: note_on/note_off (note, velocity), program_change
+    (program), set_tempo (tempo) and time_signature (numerator, denominator).
+    """
+    pos = abs_time = running = 0
+    end = len(data)
+    while pos < end:
+        delta, pos = _read_vlq(data, pos)
+        abs_time += delta
+        status = data[pos]
+        if status >= 0x80:
+            pos += 1
+        else:
+            status = running
+        if status == 0xFF:
+            # Meta messages don't change the running status
+            meta = data[pos]
+            length, pos = _read_vlq(data, pos + 1)
+            payload = data[pos:pos + length]
+            pos += length
+            if meta == 0x51:
+                yield abs_time, 'set_tempo', 0, int.from_bytes(payload, 'big'), 0
+            elif meta == 0x58:
+                yield abs_time, 'time_signature', 0, payload[0], 2 ** payload[1]
+            elif meta == 0x2F:
+                return
+            continue
+        if status in (0xF0, 0xF7):
+            # Sysex cancels the running status
+            running = 0
+            length, pos = _read_vlq(data, pos)
+            pos += length
+            continue
+        running = status
+        kind, channel = status & 0xF0, status & 0x0F
+        if kind in (0xC0, 0xD0):
+            if kind == 0xC0:
+                yield abs_time, 'program_change', channel, data[pos], 0
+            pos += 1
+            continue
+        a, b = data[pos], data[pos + 1]
+        pos += 2
+        if kind == 0x90:
+            yield abs_time, 'note_on', channel, a, b
+        elif kind == 0x80:
+            yield abs_time, 'note_off', channel, a, b
+
+def _pair_notes(events, min_velocity):
+    """
+    Pair note starts and ends in one pass. Open notes live in a stack per
+    (channel, pitch) so each note-off closes the latest matching start in O(1).
+    Returns the track data dict, or None when the track has no notes.
+    """
+    notes = []
+    active = {}
+    channels = {}
+    last = prog = seq = 0
+    for abs_time, kind, channel, a, b in events:
+        if kind == 'program_change':
+            prog = a
+        elif kind == 'note_off' or (kind == 'note_on' and b < min_velocity):
+            channels.setdefault(channel, len(channels))
+            stack = active.get((channel, a))
+            if stack:
+                start, vel, _ = stack.pop()
+                delta = start - last
+                entry = [delta, a, vel, abs_time - start]
+                if channel: entry.append(channel)
                 notes.append(entry)
-                last = note['start']
+                last = start
+        elif kind == 'note_on':
+            channels.setdefault(channel, len(channels))
+            active.setdefault((channel, a), []).append((abs_time, b, seq))
+            seq += 1
+
+    # Add remaining active notes (handle hanging notes) per channel in start order
+    hanging = sorted(
+        (channels[channel], start[2], channel, pitch, start)
+        for (channel, pitch), stack in active.items() for start in stack
+    )
+    for _, _, channel, pitch, (start, vel, _) in hanging:
+        delta = start - last
+        entry = [delta, pitch, vel, 0]  # 0 duration for hanging notes
+        if channel: entry.append(channel)
+        notes.append(entry)
+        last = start
+
+    if not notes:
+        return None
+    track_data = {'n': notes}
+    if prog != 0:
+        track_data['i'] = prog
+    return track_data
 
-        if notes:
-            track_data = {'n': notes}
-            if prog != 0:
-                track_data['i'] = prog
+def _split_global_events(events, global_events):
+    """Collect tempo and time signature events into global_events, pass the rest through."""
+    for event in events:
+        if event[1] == 'set_tempo':
+            global_events.append(['t', event[0], int(mido.tempo2bpm(event[3]))])
+        elif event[1] == 'time_signature':
+            global_events.append(['s', event[0], event[3], event[4]])
+        else:
+            yield event
+
+def iter_midi_tracks(midi_path, min_velocity=10):
+    """
+    Stream a MIDI file (path or binary file object) one track at a time without
+    loading the whole file. Yields (ticks_per_beat, global_events, track_data)
+    per track, where global_events are the tempo and time signature events of
+    that track and track_data is None for tracks without notes.
+    """
+    if hasattr(midi_path, 'read'):
+        opened = contextlib.nullcontext(midi_path)
+    else:
+        opened = open(midi_path, 'rb')
+    with opened as f:
+        header = f.read(8)
+        if len(header) < 8 or header[:4] != b'MThd':
+            raise ValueError("not a MIDI file")
+        length = struct.unpack('>I', header[4:])[0]
+        _, _, ticks_per_beat = struct.unpack('>HHH', f.read(6))
+        f.seek(length - 6, 1)
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                break
+            chunk_type, length = struct.unpack('>4sI', header)
+            if chunk_type != b'MTrk':
+                f.seek(length, 1)
+                continue
+            global_events = []
+            events = _split_global_events(_iter_track_events(f.read(length)), global_events)
+            track_data = _pair_notes(events, min_velocity)
+            yield ticks_per_beat, global_events, track_data
+
+def midi_to_text(midi_path, min_velocity=10):
+    """Convert MIDI to ultra-compact text representation with duration handling."""
+    song = None
+    for ticks_per_beat, global_events, track_data in iter_midi_tracks(midi_path, min_velocity):
+        if song is None:
+            song = {'q': ticks_per_beat, 't': []}
+            # Global events come from the first track
+            if global_events:
+                song['g'] = global_events
+        if track_data:
             song['t'].append(track_data)
 
     return json.dumps(song, separators=(',', ':'))
 
-def text_to_midi(text_repr, output_path):
-    """Convert compact text representation back to MIDI."""
-    if isinstance(text_repr, str):
-        data = json.loads(text_repr)
+def notes_to_array(notes):
+    """Convert a list of [delta, note, vel, dur(, channel)] notes to a NOTE_DTYPE array."""
+    if isinstance(notes, np.ndarray):
+        return notes
+    arr = np.zeros(len(notes), dtype=NOTE_DTYPE)
+    if not len(notes):
+        return arr
+    if all(len(note) == 4 for note in notes):
+        cols = np.array(notes, dtype=np.int64).reshape(-1, 4)
     else:
-        data = text_repr
-    midi = MIDIFile(len(data['t']), data['q'])
-    ppq = data['q']
-
-    # Add global events
-    if 'g' in data:
-        for evt in data['g']:
-            t = evt[1] / ppq
+        cols = np.array([note[:5] + [0] * (5 - len(note)) for note in notes], dtype=np.int64)
+        arr['channel'] = cols[:, 4]
+    arr['delta'] = cols[:, 0]
+    arr['pitch'] = cols[:, 1]
+    arr['velocity'] = cols[:, 2]
+    arr['duration'] = cols[:, 3]
+    return arr
+
+def array_to_notes(arr):
+    """Convert a NOTE_DTYPE array back to note lists, channel only when not 0."""
+    cols = np.stack([arr['delta'], arr['pitch'], arr['velocity'], arr['duration'], arr['channel']], axis=1).tolist()
+    return [note if note[4] else note[:4] for note in cols]
+
+def song_to_arrays(text_repr):
+    """Song with every track's note list replaced by a NOTE_DTYPE array."""
+    data = _load_song(text_repr)
+    song = dict(data)
+    song['t'] = [dict(track, n=notes_to_array(track['n'])) for track in data['t']]
+    return song
+
+def arrays_to_song(song):
+    """Inverse of song_to_arrays."""
+    data = dict(song)
+    data['t'] = [dict(track, n=array_to_notes(track['n'])) for track in song['t']]
+    return data
+
+def absolute_times(notes):
+    """Absolute start tick of every note."""
+    return np.cumsum(notes['delta'], dtype=np.int64)
+
+# Binary song format, little endian:
+#   header  magic, version, flags, track count, ticks per beat, global event count
+#   global  GLOBAL_DTYPE record per 'g' event
+#   track   note count and program (-1 for none), then NOTE_DTYPE records
+SONG_MAGIC = b'MXSG'
+SONG_VERSION = 1
+SONG_HAS_GLOBALS = 0x01
+_SONG_HEADER = struct.Struct('<4sBBHII')
+_TRACK_HEADER = struct.Struct('<Ii')
+GLOBAL_DTYPE = np.dtype([
+    ('kind', 'S1'),  # 't' tempo, 's' time signature
+    ('tick', '<i4'),
+    ('a', '<f8'),    # bpm or numerator
+    ('b', '<i4'),    # denominator
+])
+
+def _number(value):
+    return int(value) if float(value).is_integer() else float(value)
+
+def song_to_bytes(text_repr):
+    """Pack a song (JSON text, note lists or NOTE_DTYPE arrays) into the binary song format."""
+    data = _load_song(text_repr)
+    events = data.get('g', [])
+    globals_arr = np.zeros(len(events), dtype=GLOBAL_DTYPE)
+    for i, evt in enumerate(events):
+        if evt[0] not in ('t', 's'):
+            raise ValueError(f"Unknown global event {evt[0]!r}")
+        globals_arr[i] = (evt[0].encode(), evt[1], evt[2], evt[3] if evt[0] == 's' else 0)
+    flags = SONG_HAS_GLOBALS if 'g' in data else 0
+    parts = [_SONG_HEADER.pack(SONG_MAGIC, SONG_VERSION, flags, len(data['t']), data['q'], len(events)),
+             globals_arr.tobytes()]
+    for track in data['t']:
+        notes = notes_to_array(track['n'])
+        parts.append(_TRACK_HEADER.pack(len(notes), track.get('i', -1)))
+        parts.append(notes.tobytes())
+    return b''.join(parts)
+
+def _unpack_song(buffer, offset=0):
+    """Read one binary song at offset, returns (song with NOTE_DTYPE array views, end offset)."""
+    view = memoryview(buffer)
+    if len(view) - offset < _SONG_HEADER.size:
+        raise ValueError("not a binary song")
+    magic, version, flags, track_count, q, global_count = _SONG_HEADER.unpack_from(view, offset)
+    if magic != SONG_MAGIC:
+        raise ValueError("not a binary song")
+    if version != SONG_VERSION:
+        raise ValueError(f"Unsupported binary song version {version}")
+    offset += _SONG_HEADER.size
+    events = np.frombuffer(view, dtype=GLOBAL_DTYPE, count=global_count, offset=offset)
+    offset += events.nbytes
+    song = {'q': q, 't': []}
+    for _ in range(track_count):
+        count, program = _TRACK_HEADER.unpack_from(view, offset)
+        offset += _TRACK_HEADER.size
+        track = {'n': np.frombuffer(view, dtype=NOTE_DTYPE, count=count, offset=offset)}
+        offset += track['n'].nbytes
+        if program >= 0:
+            track['i'] = program
+        song['t'].append(track)
+    if flags & SONG_HAS_GLOBALS:
+        song['g'] = [
+            ['t', int(tick), _number(a)] if kind == b't' else ['s', int(tick), int(a), int(b)]
+            for kind, tick, a, b in events.tolist()
+        ]
+    return song, offset
+
+def song_from_bytes(buffer):
+    """
+    Load a binary song without copying the notes: every track's 'n' is a
+    read-only NOTE_DTYPE array over buffer (bytes, bytearray, memoryview or mmap).
+    Pass it to arrays_to_song for the note list form.
+    """
+    return _unpack_song(buffer)[0]
+
+def iter_songs_from_bytes(buffer):
+    """Yield the songs of a buffer holding several binary songs back to back."""
+    offset = 0
+    while offset < len(buffer):
+        song, offset = _unpack_song(buffer, offset)
+        yield song
+
+def _encode_events(ticks, messages):
+    """
+    Encode sorted events as MTrk data: variable-length delta times followed by
+    fixed-width messages, all in one vectorized pass.
+    """
+    deltas = np.diff(ticks, prepend=0).astype(np.int64)
+    lengths = 1 + (deltas >= 0x80) + (deltas >= 0x4000) + (deltas >= 0x200000)
+    width = messages.shape[1]
+    offsets = np.cumsum(lengths + width) - (lengths + width)
+    out = np.zeros(int((lengths + width).sum()), dtype=np.uint8)
+    for k in range(4):
+        idx = np.nonzero(lengths > k)[0]
+        byte = (deltas[idx] >> (7 * k)) & 0x7F
+        if k:
+            byte |= 0x80
+        out[offsets[idx] + lengths[idx] - 1 - k] = byte
+    for k in range(width):
+        out[offsets + lengths + k] = messages[:, k]
+    return out.tobytes()
+
+def _vlq(value):
+    """Variable-length quantity of a single value."""
+    out = [value & 0x7F]
+    value >>= 7
+    while value:
+        out.append(0x80 | (value & 0x7F))
+        value >>= 7
+    return bytes(reversed(out))
+
+def _track_chunk(body):
+    body += b'\x00\xff\x2f\x00'  # end of track
+    return b'MTrk' + struct.pack('>I', len(body)) + body
+
+def midi_globals(events):
+    """
+    (tick, meta message) of every global event a MIDI file gets, in tick order:
+    tempo and time signature events, other kinds and malformed ones are skipped.
+    """
+    messages = []
+    for evt in events:
+        try:
+            order = float(evt[1])
+            tick = max(0, int(evt[1]))
             if evt[0] == 't':
-                midi.addTempo(0, t, evt[2])
+                tempo = int(round(60000000 / evt[2]))
+                msg = b'\xff\x51\x03' + tempo.to_bytes(3, 'big')
             elif evt[0] == 's':
-                midi.addTimeSignature(0, t, evt[2], evt[3], 24, 8)
-
-    # Process tracks
-    for tidx, track in enumerate(data['t']):
-        if 'i' in track:
-            midi.addProgramChange(tidx, 0, 0, track['i'])
-        
-        abs_time = 0
-        for note in track['n']:
-            abs_time += note[0]
-            dur = note[3] / ppq
-            midi.addNote(
-                tidx,
-                note[4] if len(note) > 4 else 0,
-                note[1],
-                abs_time / ppq,
-                dur,
-                note[2]
-            )
-
-    with open(output_path, 'wb') as f:
-        midi.writeFile(f)
+                denominator = int(evt[3]).bit_length() - 1
+                msg = b'\xff\x58\x04' + bytes([int(evt[2]), denominator, 24, 8])
+            else:
+                continue
+        except (IndexError, TypeError, ValueError, OverflowError, ZeroDivisionError):
+            continue
+        messages.append((order, tick, msg))
+    messages.sort(key=lambda message: message[0])
+    return [(tick, msg) for _, tick, msg in messages]
+
+def _global_track(events):
+    body = b''
+    last = 0
+    for tick, msg in midi_globals(events):
+        body += _vlq(tick - last) + msg
+        last = tick
+    return _track_chunk(body)
+
+def _note_track(track):
+    notes = notes_to_array(track['n'])
+    start = np.maximum(absolute_times(notes), 0)
+    end = start + np.maximum(notes['duration'], 0)
+    n = len(notes)
+    ticks = np.concatenate([end, start])
+    # Note-offs sort before note-ons on the same tick so repeated notes retrigger
+    order = np.lexsort((np.repeat([0, 1], n), ticks), axis=0)
+    messages = np.empty((2 * n, 3), dtype=np.uint8)
+    messages[:n, 0] = 0x80 | notes['channel']
+    messages[n:, 0] = 0x90 | notes['channel']
+    messages[:, 1] = np.tile(notes['pitch'], 2)
+    messages[:n, 2] = 0
+    messages[n:, 2] = notes['velocity']
+    body = b''
+    if 'i' in track:
+        body = bytes([0, 0xC0, track['i']])
+    return _track_chunk(body + _encode_events(ticks[order], messages[order]))
+
+def write_midi_bytes(text_repr):
+    """
+    Build a format 1 MIDI file straight from the compact representation
+    (note lists or NOTE_DTYPE arrays): a tempo track plus one track per 't' entry.
+    """
+    data = _load_song(text_repr)
+    header = b'MThd' + struct.pack('>IHHH', 6, 1, len(data['t']) + 1, data['q'])
+    return header + _global_track(data.get('g', [])) + b''.join(_note_track(track) for track in data['t'])
+
+def text_to_midi(text_repr, output_path):
+    """Convert compact text representation back to MIDI (file path or binary file object)."""
+    midi_data = write_midi_bytes(text_repr)
+    if hasattr(output_path, 'write'):
+        output_path.write(midi_data)
+    else:
+        with open(output_path, 'wb') as f:
+            f.write(midi_data)
+
+class NoteStreamParser:
+    """
+    Incremental parser for the compact song JSON while it is still being generated.
+    feed() takes the next piece of text and returns the notes it completed as
+    (track index, note) pairs; song() parses the whole document once it is done.
+    Anything around the JSON object, such as code fences, is ignored.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.offset = 0      # characters consumed so far
+        self.start = None    # offset of the opening brace of the song
+        self.end = None      # offset just past its closing brace
+        self.stack = []      # [kind, key in parent, current key, expecting key] per open container
+        self.string = None   # characters of the string being read
+        self.escape = False
+        self.token = []      # characters of the number or literal being read
+        self.note = None     # values of the note being read
+        self.q = None
+        self.track = -1
+
+    def _in_notes(self, depth=1):
+        # True when the container depth levels down is the 'n' array of a track
+        return len(self.stack) >= depth and self.stack[-depth][0] == '[' and self.stack[-depth][1] == 'n'
+
+    def _flush_token(self):
+        if not self.token:
+            return
+        value = ''.join(self.token)
+        self.token = []
+        if self.note is not None and self._in_notes(2):
+            self.note.append(int(float(value)))
+        elif len(self.stack) == 1 and self.stack[0][2] == 'q':
+            self.q = int(float(value))
+
+    def feed(self, text):
+        self.chunks.append(text)
+        notes = []
+        for i, c in enumerate(text):
+            if self.end is not None:
+                break
+            if self.string is not None:
+                if self.escape:
+                    self.escape = False
+                elif c == '\\':
+                    self.escape = True
+                elif c == '"':
+                    top = self.stack[-1]
+                    if top[0] == '{' and top[3]:
+                        top[2] = ''.join(self.string)
+                    self.string = None
+                else:
+                    self.string.append(c)
+                continue
+            if not self.stack and c != '{':
+                continue
+            if c == '"':
+                self.string = []
+            elif c in '{[':
+                if not self.stack:
+                    self.start = self.offset + i
+                elif c == '{' and self.stack[-1][0] == '[' and self.stack[-1][1] == 't':
+                    self.track += 1
+                elif c == '[' and self._in_notes():
+                    self.note = []
+                parent_key = self.stack[-1][2] if self.stack and self.stack[-1][0] == '{' else None
+                self.stack.append([c, parent_key, None, c == '{'])
+            elif c in '}],':
+                self._flush_token()
+                if c == ',':
+                    if self.stack[-1][0] == '{':
+                        self.stack[-1][3] = True
+                    continue
+                self.stack.pop()
+                if c == ']' and self.note is not None and self._in_notes():
+                    notes.append((self.track, self.note))
+                    self.note = None
+                if not self.stack:
+                    self.end = self.offset + i + 1
+            elif c == ':':
+                self.stack[-1][3] = False
+            elif c.isspace():
+                self._flush_token()
+            else:
+                self.token.append(c)
+        self.offset += len(text)
+        return notes
+
+    def song(self):
+        """The complete song, raises ValueError when the document is cut short."""
+        if self.end is None:
+            raise ValueError("Incomplete song JSON")
+        return json.loads(''.join(self.chunks)[self.start:self.end])
+
+def _load_song(text_repr):
+    return json.loads(text_repr) if isinstance(text_repr, str) else text_repr
+
+def _beat_info(data):
+    """Return (ticks per beat, beats per bar) from the time signature at tick 0."""
+    numerator, denominator = 4, 4
+    for evt in data.get('g', []):
+        if evt[0] == 's' and evt[1] == 0:
+            numerator, denominator = evt[2], evt[3]
+    return data['q'] * 4 // denominator, numerator
+
+def _with_tempos(data, tempos):
+    """Shallow copy of the song with its tempo events replaced, notes are shared."""
+    song = dict(data)
+    song['g'] = sorted([evt for evt in data.get('g', []) if evt[0] != 't'] + tempos, key=lambda evt: evt[1])
+    return song
+
+def retime(text_repr, bpm):
+    """Rewrite the song to a single constant tempo of bpm."""
+    return _with_tempos(_load_song(text_repr), [['t', 0, round(bpm, 2)]])
+
+def tempo_ramp(text_repr, start_bpm, end_bpm, bars):
+    """
+    Rewrite the song tempo to glide from start_bpm to end_bpm over the first
+    bars bars, one tempo event per beat, then hold end_bpm.
+    """
+    data = _load_song(text_repr)
+    beat, beats_per_bar = _beat_info(data)
+    steps = max(1, int(bars * beats_per_bar))
+    tempos = [
+        ['t', i * beat, round(start_bpm + (end_bpm - start_bpm) * i / steps, 2)]
+        for i in range(steps + 1)
+    ]
+    return _with_tempos(data, tempos)
+
+def song_window(text_repr, start_tick, end_tick):
+    """
+    Notes of every track starting in [start_tick, end_tick), moved to start at
+    tick 0, as NOTE_DTYPE arrays. Global events before end_tick move to tick 0.
+    """
+    data = song_to_arrays(text_repr)
+    song = dict(data)
+    song['t'] = []
+    for track in data['t']:
+        times = absolute_times(track['n'])
+        mask = (times >= start_tick) & (times < end_tick)
+        notes = track['n'][mask].copy()
+        notes['delta'] = np.diff(times[mask] - start_tick, prepend=0)
+        song['t'].append(dict(track, n=notes))
+    song['g'] = [[evt[0], max(0, evt[1] - start_tick)] + list(evt[2:])
+                 for evt in data.get('g', []) if evt[1] < end_tick]
+    return song
 
 def process_midi_example(input_path, output_path):
     text_repr = midi_to_text(input_path)
@@ -118,5 +559,122 @@ def process_midi_example(input_path, output_path):
     text_to_midi(text_repr, output_path)
     print(f"MIDI reconstructed to {output_path}")
 
+MIDI_EXTENSIONS = ('.mid', '.midi')
+
+def _absolute_notes(song):
+    """Per track: program and the sorted absolute (start, note, vel, dur, channel) tuples."""
+    tracks = []
+    for track in song['t']:
+        notes = notes_to_array(track['n'])
+        starts = absolute_times(notes)
+        tracks.append((track.get('i', 0), sorted(zip(
+            starts.tolist(), notes['pitch'].tolist(), notes['velocity'].tolist(),
+            notes['duration'].tolist(), notes['channel'].tolist()
+        ))))
+    return tracks
+
+def verify_round_trip(song, min_velocity=10):
+    """Write the song back with text_to_midi, re-read it and compare the notes."""
+    midi_io = io.BytesIO()
+    text_to_midi(song, midi_io)
+    midi_io.seek(0)
+    again = json.loads(midi_to_text(midi_io, min_velocity))
+    return _absolute_notes(song) == _absolute_notes(again)
+
+def convert_file(path, root, min_velocity=10, verify=False):
+    """Convert one MIDI file into a corpus record with per-file stats."""
+    record = {'path': os.path.relpath(path, root)}
+    started = time.perf_counter()
+    try:
+        text_repr = midi_to_text(path, min_velocity)
+        song = json.loads(text_repr)
+        record['song'] = song
+        record['stats'] = {
+            'bytes': os.path.getsize(path),
+            'chars': len(text_repr),
+            'tracks': len(song['t']),
+            'notes': sum(len(track['n']) for track in song['t']),
+            'ticks_per_beat': song['q'],
+        }
+        if verify:
+            record['stats']['verified'] = verify_round_trip(song, min_velocity)
+    except Exception as e:
+        record.pop('song', None)
+        record['error'] = f"{type(e).__name__}: {e}"
+    record['seconds'] = round(time.perf_counter() - started, 4)
+    return record
+
+def find_midi_files(root):
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if name.lower().endswith(MIDI_EXTENSIONS):
+                yield os.path.join(dirpath, name)
+
+def _done_paths(output_path):
+    """Paths already converted successfully in an existing corpus."""
+    done = set()
+    if os.path.exists(output_path):
+        with open(output_path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # partial last line of an interrupted run
+                if 'song' in record:
+                    done.add(record['path'])
+    return done
+
+def convert_corpus(root, output_path, workers=None, resume=False, verify=False, min_velocity=10):
+    """Convert every MIDI file under root in a process pool into a JSONL corpus."""
+    done = _done_paths(output_path) if resume else set()
+    paths = [path for path in find_midi_files(root) if os.path.relpath(path, root) not in done]
+    totals = {'converted': 0, 'failed': 0, 'skipped': len(done), 'unverified': 0, 'notes': 0}
+    print(f"Converting {len(paths)} MIDI files from {root} ({len(done)} already done)")
+
+    with open(output_path, 'a' if resume else 'w') as out, ProcessPoolExecutor(workers) as pool:
+        futures = [pool.submit(convert_file, path, root, min_velocity, verify) for path in paths]
+        for future in as_completed(futures):
+            record = future.result()
+            out.write(json.dumps(record, separators=(',', ':')) + '\n')
+            if 'error' in record:
+                totals['failed'] += 1
+                print(f"Failed {record['path']}: {record['error']}")
+                continue
+            totals['converted'] += 1
+            totals['notes'] += record['stats']['notes']
+            if record['stats'].get('verified') is False:
+                totals['unverified'] += 1
+                print(f"Round trip mismatch {record['path']}")
+
+    print(", ".join(f"{key}: {value}" for key, value in totals.items()))
+    return totals
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="MIDI <-> compact JSON tools")
+    commands = parser.add_subparsers(dest='command')
+
+    example = commands.add_parser('example', help="round trip rivers.mid (default)")
+    example.add_argument('input', nargs='?', default="rivers.mid")
+    example.add_argument('output', nargs='?', default="rivers2.mid")
+
+    batch = commands.add_parser('batch', help="convert a directory tree of MIDI files to a JSONL corpus")
+    batch.add_argument('root', help="directory searched recursively for .mid/.midi files")
+    batch.add_argument('-o', '--output', default="corpus.jsonl")
+    batch.add_argument('-j', '--workers', type=int, default=None, help="worker processes (default: CPU count)")
+    batch.add_argument('--resume', action='store_true', help="append to the corpus, skipping files already converted")
+    batch.add_argument('--verify', action='store_true', help="check every song round trips through text_to_midi")
+    batch.add_argument('--min-velocity', type=int, default=10)
+
+    args = parser.parse_args(argv)
+    if args.command == 'batch':
+        totals = convert_corpus(args.root, args.output, args.workers, args.resume, args.verify, args.min_velocity)
+        return 1 if totals['failed'] or totals['unverified'] else 0
+    if args.command == 'example':
+        process_midi_example(args.input, args.output)
+    else:
+        process_midi_example("rivers.mid", "rivers2.mid")
+    return 0
+
 if __name__ == "__main__":
-    process_midi_example("rivers.mid", "rivers2.mid")
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
@@ -1,9 +1,13 @@
-from fastapi import APIRouter, UploadFile, File, HTTPException
-from schemas import BPMUpdate
+from fastapi import APIRouter, UploadFile, File, Form, HTTPException, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from schemas import BPMUpdate, HeartBeatBatch
 from services.audio_service import AudioService
-from typing import Dict
+from services.job_queue import JobQueue, QueueFullError
+from typing import Dict, Literal
 import mimetypes
 import os
+import time
+import asyncio
 import json
 from pydantic import BaseModel
 from typing import List, Optional
@@ -17,19 +21,68 @@ class AudioAnalysisResponse(BaseModel):
     filename: str
     analysis: Dict
     success: bool = True
+    cached: bool = False
+    note_id: Optional[int] = None
+
+class BatchAudioResult(BaseModel):
+    filename: str
+    success: bool
+    cached: bool = False
+    note_id: Optional[int] = None
+    analysis: Optional[Dict] = None
+    error: Optional[str] = None
+
+class BatchAudioResponse(BaseModel):
+    message: str
+    succeeded: int
+    failed: int
+    results: List[BatchAudioResult]
 
 router = APIRouter()
 audio_service = AudioService()
 
+ACCEPTED_EXTENSIONS = ['.ogg', '.mp3', '.wav', '.m4a', '.mp4']
+
+def _parse_analysis(result: Dict) -> Dict:
+    # If the analysis is returned as a string (JSON), parse it
+    if isinstance(result["analysis"], str):
+        try:
+            result["analysis"] = json.loads(result["analysis"])
+        except json.JSONDecodeError:
+            raise Exception("Failed to parse analysis result")
+    return result
+
+async def _analyze_job(upload) -> Dict:
+    result = _parse_analysis(await audio_service.analyze_upload(upload))
+    return AudioAnalysisResponse(**result).model_dump()
+
+job_queue = JobQueue(
+    handler=_analyze_job,
+    workers=int(os.getenv("AUDIO_JOB_WORKERS", "4")),
+    max_queued=int(os.getenv("AUDIO_JOB_QUEUE_SIZE", "100")),
+    retention_seconds=float(os.getenv("AUDIO_JOB_RETENTION_MINUTES", "60")) * 60,
+    discard=lambda upload: upload.close(),
+)
+
 @router.post("/audio", response_model=AudioAnalysisResponse)
-async def upload_audio(file: UploadFile = File(...)):
+async def upload_audio(
+    request: Request,
+    file: UploadFile = File(...),
+    user_id: Optional[str] = Form(None, max_length=128),
+    mode: Literal["sync", "async"] = "sync",
+):
     """
-    Upload an audio file and analyze it.
+    Upload an audio file and analyze it. The analysis is stored as a diary
+    note of user_id, see /diary/notes.
+    With mode=async the file is queued and the response is 202 with a job id,
+    poll /audio/jobs/{job_id} or listen on /audio/jobs/{job_id}/events for the result.
     Returns:
     {
         "message": "string",
         "filename": "string",
         "success": boolean,
+        "cached": boolean,
+        "note_id": int | null,
         "analysis": {
             "transcript": "string",
             "classification": "string",
@@ -45,41 +98,180 @@ async def upload_audio(file: UploadFile = File(...)):
     # Get file extension
     file_ext = os.path.splitext(file.filename)[1].lower()
     
-    # List of accepted audio extensions
-    accepted_extensions = ['.ogg', '.mp3', '.wav', '.m4a', '.mp4']
-    
-    if file_ext not in accepted_extensions:
+    if file_ext not in ACCEPTED_EXTENSIONS:
         raise HTTPException(
             status_code=400,
-            detail=f"Invalid file extension. Accepted extensions are: {', '.join(accepted_extensions)}"
+            detail=f"Invalid file extension. Accepted extensions are: {', '.join(ACCEPTED_EXTENSIONS)}"
+        )
+    
+    if mode == "async":
+        upload = await audio_service.spool_upload(file, user_id)
+        try:
+            job = job_queue.submit(file.filename, upload)
+        except QueueFullError as e:
+            upload.close()
+            raise HTTPException(
+                status_code=503,
+                detail=str(e)
+            )
+        return JSONResponse(
+            status_code=202,
+            content={
+                "job_id": job.id,
+                "status": job.status,
+                "status_url": str(request.url_for("get_audio_job", job_id=job.id)),
+                "events_url": str(request.url_for("audio_job_events", job_id=job.id)),
+            }
         )
     
     try:
-        result = await audio_service.save_audio(file)
-        
-        # If the analysis is returned as a string (JSON), parse it
-        if isinstance(result["analysis"], str):
-            try:
-                result["analysis"] = json.loads(result["analysis"])
-            except json.JSONDecodeError:
-                raise HTTPException(
-                    status_code=500,
-                    detail="Failed to parse analysis result"
-                )
+        result = _parse_analysis(await audio_service.save_audio(file, user_id))
         
         return AudioAnalysisResponse(
             message=result["message"],
             filename=result["filename"],
             analysis=result["analysis"],
-            success=True
+            success=True,
+            cached=result["cached"],
+            note_id=result["note_id"]
         )
     
+    except asyncio.TimeoutError:
+        raise HTTPException(
+            status_code=504,
+            detail="Audio analysis timed out"
+        )
     except Exception as e:
         raise HTTPException(
             status_code=500,
             detail=str(e)
         )
 
+async def _analyze_batch_file(file: UploadFile, user_id: Optional[str], semaphore: asyncio.Semaphore) -> BatchAudioResult:
+    file_ext = os.path.splitext(file.filename or "")[1].lower()
+    if file_ext not in ACCEPTED_EXTENSIONS:
+        return BatchAudioResult(
+            filename=file.filename or "",
+            success=False,
+            error=f"Invalid file extension. Accepted extensions are: {', '.join(ACCEPTED_EXTENSIONS)}"
+        )
+    try:
+        async with semaphore:
+            upload = await audio_service.spool_upload(file, user_id)
+            result = _parse_analysis(await audio_service.analyze_upload(upload))
+        return BatchAudioResult(
+            filename=result["filename"],
+            success=True,
+            cached=result["cached"],
+            note_id=result["note_id"],
+            analysis=result["analysis"]
+        )
+    except asyncio.TimeoutError:
+        return BatchAudioResult(filename=file.filename, success=False, error="Audio analysis timed out")
+    except Exception as e:
+        return BatchAudioResult(filename=file.filename, success=False, error=str(e))
+
+@router.post("/audio/batch", response_model=BatchAudioResponse)
+async def upload_audio_batch(
+    files: List[UploadFile] = File(...),
+    user_id: Optional[str] = Form(None, max_length=128),
+):
+    """
+    Upload several audio files in one request and analyze them concurrently.
+    A file that fails does not fail the batch, check success on each result.
+    Returns:
+    {
+        "message": "string",
+        "succeeded": int,
+        "failed": int,
+        "results": [
+            {
+                "filename": "string",
+                "success": boolean,
+                "cached": boolean,
+                "note_id": int | null,
+                "analysis": {...} | null,
+                "error": "string" | null
+            }
+        ]
+    }
+    """
+    max_files = int(os.getenv("AUDIO_BATCH_MAX_FILES", "50"))
+    if len(files) > max_files:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Too many files, at most {max_files} per batch"
+        )
+    
+    semaphore = asyncio.Semaphore(int(os.getenv("AUDIO_BATCH_CONCURRENCY", "8")))
+    results = await asyncio.gather(*(_analyze_batch_file(file, user_id, semaphore) for file in files))
+    succeeded = sum(1 for result in results if result.success)
+    return BatchAudioResponse(
+        message=f"Analyzed {succeeded} of {len(results)} files",
+        succeeded=succeeded,
+        failed=len(results) - succeeded,
+        results=results
+    )
+
+def _get_job(job_id: str):
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(
+            status_code=404,
+            detail="Job not found"
+        )
+    return job
+
+@router.get("/audio/jobs/{job_id}")
+async def get_audio_job(job_id: str):
+    """
+    Status of a queued analysis job.
+    Returns:
+    {
+        "job_id": "string",
+        "filename": "string",
+        "status": "queued" | "running" | "done" | "failed",
+        "result": AudioAnalysisResponse | null,
+        "error": "string" | null
+    }
+    """
+    return _get_job(job_id).to_dict()
+
+@router.get("/audio/jobs/{job_id}/events")
+async def audio_job_events(job_id: str):
+    """
+    Server-sent events for a queued analysis job, one status event per change
+    until the job is done or failed.
+    """
+    job = _get_job(job_id)
+
+    async def events():
+        async for update in job_queue.watch(job):
+            if update is None:
+                yield ": keep-alive\n\n"
+            else:
+                yield f"event: status\ndata: {json.dumps(update.to_dict())}\n\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"}
+    )
+
+@router.get("/audio/jobs")
+async def audio_job_stats():
+    """
+    Worker count and queue depth of the analysis job queue.
+    """
+    return job_queue.stats()
+
+@router.get("/audio/cache")
+async def analysis_cache_stats():
+    """
+    Analysis cache size and hit/miss counters.
+    """
+    return audio_service.cache.stats()
+
 class BPMResponse(BaseModel):
     message: str
     bpm: float
@@ -97,7 +289,7 @@ async def update_bpm(bpm_data: BPMUpdate):
     }
     """
     try:
-        result = await audio_service.update_bpm(bpm_data.bpm)
+        result = await audio_service.update_bpm(bpm_data.bpm, bpm_data.user_id, bpm_data.timestamp)
         return BPMResponse(
             message=result["message"],
             bpm=result["bpm"],
@@ -107,4 +299,93 @@ async def update_bpm(bpm_data: BPMUpdate):
         raise HTTPException(
             status_code=500,
             detail=str(e)
-        )
\ No newline at end of file
+        )
+
+class HeartRateAnalysisResponse(BaseModel):
+    message: str
+    bpm: float
+    mean_bpm: float
+    trend_bpm_per_minute: float
+    rmssd_ms: float
+    sdnn_ms: float
+    beats: int
+    rejected: int
+    success: bool = True
+
+@router.post("/bpm/batch", response_model=HeartRateAnalysisResponse)
+async def analyze_heart_rate(batch: HeartBeatBatch):
+    """
+    Analyze a batch of raw beats, sent as RR intervals or beat timestamps (ms).
+    Glitches and outliers are rejected before smoothing.
+    Returns:
+    {
+        "message": "string",
+        "bpm": float,
+        "mean_bpm": float,
+        "trend_bpm_per_minute": float,
+        "rmssd_ms": float,
+        "sdnn_ms": float,
+        "beats": int,
+        "rejected": int,
+        "success": boolean
+    }
+    """
+    try:
+        result = await audio_service.analyze_heart_rate(
+            batch.rr_intervals, batch.timestamps, batch.user_id, batch.end_time
+        )
+        return HeartRateAnalysisResponse(**result, success=True)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=422,
+            detail=str(e)
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=str(e)
+        )
+
+@router.get("/bpm/history")
+async def heart_rate_history(
+    user_id: str,
+    start: float,
+    end: Optional[float] = None,
+    resolution: Literal["auto", "raw", "minute", "hour"] = "auto",
+):
+    """
+    Heart rate of a user between start and end (unix seconds, end defaults to now).
+    auto returns raw samples while they are still buffered, per-minute
+    rollups for up to two days and per-hour rollups beyond.
+    Returns:
+    {
+        "user_id": "string",
+        "resolution": "raw" | "minute" | "hour",
+        "start": float,
+        "end": float,
+        "points": [
+            {"t": float, "bpm": float}, // raw
+            {"t": int, "bpm": float, "count": int, "min": float, "max": float} // rollups
+        ]
+    }
+    """
+    end = time.time() if end is None else end
+    if end <= start:
+        raise HTTPException(
+            status_code=400,
+            detail="end must be after start"
+        )
+    try:
+        return await audio_service.heart_rate_history(user_id, start, end, resolution)
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=str(e)
+        )
+
+@router.get("/bpm/history/stats")
+async def heart_rate_store_stats():
+    """
+    Users and samples held in the heart-rate ring buffers.
+    """
+    return audio_service.heart_rate_store.stats()
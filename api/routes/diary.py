@@ -0,0 +1,147 @@
+from fastapi import APIRouter, HTTPException, Query
+from routes.audio import audio_service
+from services.audio_service import VALID_TAGS
+from services.executor import store_executor
+from typing import Literal, Optional
+import time
+
+router = APIRouter()
+
+Classification = Literal[tuple(VALID_TAGS)]
+
+
+@router.get("/diary/notes")
+async def list_diary_notes(
+    user_id: Optional[str] = None,
+    classification: Optional[Classification] = None,
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+    cursor: Optional[int] = None,
+    limit: int = Query(20, ge=1, le=100),
+):
+    """
+    Diary notes newest first, filtered by user, classification and time
+    (unix seconds, start <= created_at < end). Pass next_cursor back as
+    cursor for the next page, it is null on the last page.
+    Returns:
+    {
+        "notes": [
+            {
+                "id": int,
+                "user_id": "string" | null,
+                "created_at": float,
+                "filename": "string",
+                "classification": "string",
+                "transcript": "string",
+                "irrational_ideas": [{"title": "string", "description": "string"}]
+            }
+        ],
+        "next_cursor": int | null
+    }
+    """
+    try:
+        return await audio_service.diary_notes(
+            user_id=user_id, classification=classification, start=start, end=end, cursor=cursor, limit=limit
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=str(e)
+        )
+
+
+@router.get("/diary/search")
+async def search_diary_notes(
+    q: str = Query(..., min_length=1, max_length=256),
+    field: Literal["all", "transcript", "ideas"] = "all",
+    user_id: Optional[str] = None,
+    classification: Optional[Classification] = None,
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+    cursor: Optional[int] = None,
+    limit: int = Query(20, ge=1, le=100),
+):
+    """
+    Full-text search over transcripts and irrational-idea titles. Notes
+    must contain every word of q, accents and case are ignored and a
+    trailing * matches a prefix. Filters and pages like /diary/notes, each
+    note has a snippet with the matches in [brackets].
+    """
+    try:
+        return await audio_service.search_diary(
+            q, field=field, user_id=user_id, classification=classification,
+            start=start, end=end, cursor=cursor, limit=limit
+        )
+    except ValueError as e:
+        raise HTTPException(
+            status_code=400,
+            detail=str(e)
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=str(e)
+        )
+
+
+@router.get("/diary/summary")
+async def diary_summary(
+    user_id: Optional[str] = None,
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+    interval: Literal["day", "week"] = "day",
+    top: int = Query(10, ge=1, le=100),
+):
+    """
+    Dashboard of a patient, or of all patients without user_id: notes per
+    classification and the most frequent irrational ideas between start and
+    end (unix seconds, the last 30 days by default), read from rollups kept
+    up to date as notes are analyzed.
+    Returns:
+    {
+        "user_id": "string" | null,
+        "start": float,
+        "end": float,
+        "interval": "day" | "week",
+        "notes": int,
+        "classifications": {"anxiety_expression": int, ...},
+        "series": [{"t": int, "counts": {"anxiety_expression": int, ...}}],
+        "top_irrational_ideas": [{"title": "string", "count": int}]
+    }
+    """
+    end = time.time() if end is None else end
+    start = end - 30 * 86400 if start is None else start
+    if end <= start:
+        raise HTTPException(
+            status_code=400,
+            detail="end must be after start"
+        )
+    try:
+        return await audio_service.diary_summary(start, end, user_id, interval, top)
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=str(e)
+        )
+
+
+@router.get("/diary/notes/{note_id}")
+async def get_diary_note(note_id: int):
+    """
+    One diary note with its irrational ideas.
+    """
+    note = await store_executor.run(audio_service.diary.get, note_id)
+    if note is None:
+        raise HTTPException(
+            status_code=404,
+            detail="Note not found"
+        )
+    return note
+
+
+@router.get("/diary/stats")
+async def diary_stats():
+    """
+    Number of stored notes and users.
+    """
+    return await store_executor.run(audio_service.diary.stats)
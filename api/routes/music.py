@@ -1,75 +1,141 @@
-from fastapi import APIRouter, HTTPException
-from fastapi.responses import Response
+from fastapi import APIRouter, HTTPException, Header, Query, Request
+from fastapi.responses import Response, StreamingResponse
+from services.audio_encoder import CODECS
 from services.music_generator import MusicGeneratorService
 from schemas import BPMRequest
+from typing import Literal, Optional
 import traceback
+import asyncio
+import re
 
 router = APIRouter()
 music_service = MusicGeneratorService()
 
-from midiutil import MIDIFile
-from pydub import AudioSegment
-import io
-import subprocess
-import tempfile
-import os
-
 import uuid
 
-@router.post("/generate")
-async def generate_music(bpm_request: BPMRequest):
+# Media types clients can ask for in Accept, by codec
+ACCEPT_CODECS = {
+    "audio/mpeg": "mp3",
+    "audio/mp3": "mp3",
+    "audio/ogg": "opus",
+    "audio/opus": "opus",
+    "audio/aac": "aac",
+}
+TRACK_KEY = re.compile(r"^[0-9a-f]{64}\.(mp3|ogg|aac)$")
+EXTENSION_MEDIA_TYPES = {codec.extension: codec.media_type for codec in CODECS.values()}
+
+def _negotiate_codec(accept: Optional[str]) -> Optional[str]:
     """
-    Generate calming music based on the provided BPM
+    Codec for the Accept header, highest q first. None means the default
+    format is fine, raises 406 when no supported audio type is acceptable.
     """
-    try:
-        # Generar MIDI primero
-        midi_data = await music_service.generate_music(bpm_request.bpm)
-        
-        # Crear archivos temporales para la conversión
-        with tempfile.NamedTemporaryFile(suffix='.mid', delete=False) as midi_temp:
-            midi_temp.write(midi_data)
-            midi_path = midi_temp.name
-
-        with tempfile.NamedTemporaryFile(suffix='.wav', delete=False) as wav_temp:
-            wav_path = wav_temp.name
-
-        try:
-            # Convertir MIDI a WAV usando fluidsynth
-            subprocess.run([
-                'fluidsynth',
-                '-ni',
-                '/usr/share/sounds/sf2/FluidR3_GM.sf2',  # Ruta al soundfont
-                midi_path,
-                '-F',
-                wav_path,
-                '-r',
-                '44100'
-            ], check=True)
+    if not accept:
+        return None
+    offers = []
+    for position, item in enumerate(accept.split(",")):
+        media_type, *params = [part.strip() for part in item.split(";")]
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if q > 0:
+            offers.append((-q, position, media_type.lower()))
+    for _, _, media_type in sorted(offers):
+        if media_type in ACCEPT_CODECS:
+            return ACCEPT_CODECS[media_type]
+        if media_type in ("*/*", "audio/*"):
+            return None
+    raise HTTPException(
+        status_code=406,
+        detail=f"Supported audio types are: {', '.join(ACCEPT_CODECS)}"
+    )
 
-            # Convertir WAV a MP3
-            audio = AudioSegment.from_wav(wav_path)
-            mp3_io = io.BytesIO()
-            audio.export(mp3_io, format="mp3")
-            mp3_data = mp3_io.getvalue()
+def _range_response(data: bytes, range_header: Optional[str], media_type: str, headers: dict) -> Response:
+    """Serves a single bytes range of data, or all of it without a usable Range header."""
+    headers = dict(headers, **{"Accept-Ranges": "bytes"})
+    size = len(data)
+    if not range_header or not range_header.startswith("bytes=") or "," in range_header:
+        return Response(content=data, media_type=media_type, headers=headers)
+    start, _, end = range_header[len("bytes="):].strip().partition("-")
+    try:
+        if start:
+            first = int(start)
+            last = min(int(end), size - 1) if end else size - 1
+        else:
+            # Suffix range: the last end bytes
+            first = max(0, size - int(end))
+            last = size - 1 if int(end) > 0 else -1
+    except ValueError:
+        return Response(content=data, media_type=media_type, headers=headers)
+    if first > last or first >= size:
+        headers["Content-Range"] = f"bytes */{size}"
+        return Response(status_code=416, headers=headers)
+    headers["Content-Range"] = f"bytes {first}-{last}/{size}"
+    return Response(content=data[first:last + 1], status_code=206, media_type=media_type, headers=headers)
 
-            # Generator random uuid
-            uuid_str = str(uuid.uuid4())
+@router.post("/generate")
+async def generate_music(
+    bpm_request: BPMRequest,
+    request: Request,
+    stream: bool = False,
+    format: Optional[Literal["mp3", "opus", "aac"]] = None,
+    bitrate: Optional[int] = Query(None, ge=8, le=320),
+    sample_rate: Optional[int] = Query(None, ge=8000, le=48000),
+    channels: Optional[int] = Query(None, ge=1, le=2),
+    accept: Optional[str] = Header(None),
+):
+    """
+    Generate calming music based on the provided BPM.
+    Served from the pre-rendered pool when a track is available.
+    With target_bpm the tempo glides from bpm to target_bpm over ramp_bars bars.
+    With stream=true the audio is sent in chunks while it is rendered and encoded.
+    The codec comes from format or the Accept header (mp3, opus in ogg, aac),
+    bitrate (kbps), sample_rate and channels override the default output settings.
+    The rendered file can be fetched again, with Range support, from the
+    Content-Location of the response.
+    """
+    output = music_service.output.with_changes(
+        codec=format or _negotiate_codec(accept),
+        sample_rate=sample_rate,
+        bitrate=bitrate,
+        channels=channels,
+    )
+    try:
+        # Generator random uuid
+        uuid_str = str(uuid.uuid4())
+        headers = {
+            "Content-Disposition": f"attachment; filename=calm_music_{uuid_str}bpm.{output.extension}",
+            "Vary": "Accept",
+        }
 
-            return Response(
-                content=mp3_data,
-                media_type="audio/mpeg",
-                headers={
-                    "Content-Disposition": f"attachment; filename=calm_music_{uuid_str}bpm.mp3"
-                }
+        if stream:
+            chunks, key = await music_service.open_stream(
+                bpm_request.bpm, bpm_request.target_bpm, bpm_request.ramp_bars, bpm_request.backend, output
             )
-        finally:
-            # Limpiar archivos temporales
-            for path in [midi_path, wav_path]:
-                try:
-                    os.unlink(path)
-                except OSError:
-                    pass
+            if key is not None:
+                headers["Content-Location"] = str(request.url_for("get_rendered_track", key=key))
+            return StreamingResponse(chunks, media_type=output.media_type, headers=headers)
 
+        track = await music_service.get_track(
+            bpm_request.bpm, bpm_request.target_bpm, bpm_request.ramp_bars, bpm_request.backend, output
+        )
+        headers["Content-Location"] = str(request.url_for("get_rendered_track", key=track.key))
+        headers["ETag"] = f'"{track.key}"'
+        return Response(
+            content=track.audio,
+            media_type=output.media_type,
+            headers=headers
+        )
+
+    except asyncio.TimeoutError:
+        raise HTTPException(
+            status_code=504,
+            detail="Music generation timed out"
+        )
     except Exception as e:
         print(e)
         print(traceback.format_exc())
@@ -77,4 +143,46 @@ async def generate_music(bpm_request: BPMRequest):
         raise HTTPException(
             status_code=500,
             detail=f"Error generating music: {str(e)}"
-        )
\ No newline at end of file
+        )
+
+@router.get("/generate/tracks/{key}")
+async def get_rendered_track(key: str, range_header: Optional[str] = Header(None, alias="Range")):
+    """
+    A rendered track from the render cache, by the Content-Location returned by /generate.
+    Supports single Range requests so clients can seek and resume.
+    Answers 404 once the track left the cache.
+    """
+    audio = await music_service.cached_audio(key) if TRACK_KEY.match(key) else None
+    if audio is None:
+        raise HTTPException(
+            status_code=404,
+            detail="Track not found"
+        )
+    headers = {
+        "ETag": f'"{key}"',
+        "Content-Disposition": f"attachment; filename=calm_music_{key[:16]}.{key.rsplit('.', 1)[1]}",
+    }
+    return _range_response(audio, range_header, EXTENSION_MEDIA_TYPES[key.rsplit(".", 1)[1]], headers)
+
+@router.get("/generate/pool")
+async def pool_stats():
+    """
+    Pre-rendered music pool status with hit/miss counters.
+    """
+    return music_service.pool.stats()
+
+
+@router.get("/generate/cache")
+async def render_cache_stats():
+    """
+    Rendered audio cache size and memory/disk hit counters.
+    """
+    return music_service.render_cache.stats()
+
+
+@router.get("/generate/prompt")
+async def prompt_stats():
+    """
+    Music system prompt size, build time, context cache state and token usage.
+    """
+    return music_service.prompt_stats
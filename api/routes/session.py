@@ -0,0 +1,134 @@
+from fastapi import APIRouter, Query, WebSocket, WebSocketDisconnect
+from routes.audio import audio_service
+from routes.music import music_service
+from services.audio_encoder import stream_encode
+from services.executor import render_executor
+from services.heart_rate import analyze_rr, rr_from_timestamps
+from services.heart_session import HeartRateSession, create_session
+from typing import Literal, Optional
+import traceback
+import asyncio
+import json
+import os
+
+router = APIRouter()
+
+# Segments are kept this many seconds ahead of playback
+SESSION_BUFFER_SECONDS = float(os.getenv("SESSION_BUFFER_SECONDS", "4"))
+
+
+async def _pcm_segments(segments: asyncio.Queue):
+    while (pcm := await segments.get()) is not None:
+        yield pcm
+
+
+async def _send_audio(websocket: WebSocket, session: HeartRateSession, segments: asyncio.Queue,
+                      send_lock: asyncio.Lock):
+    """Sends the output of the session encoder as it comes, one continuous stream."""
+    encoder = stream_encode(_pcm_segments(segments), music_service.synthesizer.sample_rate, session.output)
+    try:
+        async for chunk in encoder:
+            async with send_lock:
+                await websocket.send_bytes(chunk)
+    finally:
+        await encoder.aclose()
+
+
+async def _render_segments(websocket: WebSocket, session: HeartRateSession, segments: asyncio.Queue,
+                           send_lock: asyncio.Lock, tempo_known: asyncio.Event):
+    await tempo_known.wait()
+    while True:
+        ahead = session.ahead_seconds()
+        if ahead > SESSION_BUFFER_SECONDS:
+            await asyncio.sleep(ahead - SESSION_BUFFER_SECONDS)
+            continue
+        index = session.segments
+        pcm, seconds, tempo = await render_executor.run(session.render_segment)
+        segments.put_nowait(pcm)
+        async with send_lock:
+            await websocket.send_json({
+                "type": "segment",
+                "index": index,
+                "bpm": tempo,
+                "seconds": round(seconds, 3),
+            })
+
+
+@router.websocket("/session")
+async def heart_rate_session(
+    websocket: WebSocket,
+    target_bpm: Optional[float] = Query(None, ge=20, le=200),
+    format: Optional[Literal["mp3", "opus", "aac"]] = None,
+    bitrate: Optional[int] = Query(None, ge=8, le=320),
+    sample_rate: Optional[int] = Query(None, ge=8000, le=48000),
+    channels: Optional[int] = Query(None, ge=1, le=2),
+    user_id: Optional[str] = Query(None, max_length=128),
+):
+    """
+    Live heart-rate session. The client sends {"bpm": float} samples as they
+    are measured, or bursts of raw beats as {"rr_intervals": [...]} or
+    {"timestamps": [...]} in milliseconds. The server answers with a
+    {"type": "tempo"} message whenever the music tempo changes and keeps a
+    few seconds of audio queued ahead, announcing each rendered segment with
+    a {"type": "segment"} message. The audio goes through one encoder for the
+    whole session: binary messages are consecutive pieces of a single stream
+    in the session format, to be played back to back. With user_id the
+    samples are stored in the user's heart-rate history.
+    """
+    await websocket.accept()
+    output = music_service.output.with_changes(
+        codec=format, sample_rate=sample_rate, bitrate=bitrate, channels=channels
+    )
+    session = None
+    tasks = []
+    segments = asyncio.Queue()
+    send_lock = asyncio.Lock()
+    tempo_known = asyncio.Event()
+    try:
+        while True:
+            try:
+                message = json.loads(await websocket.receive_text())
+                rr = None
+                if "rr_intervals" in message or "timestamps" in message:
+                    # Raw beat bursts are cleaned and smoothed into a single reading
+                    rr = (message["rr_intervals"] if "rr_intervals" in message
+                          else rr_from_timestamps(message["timestamps"]))
+                    bpm = analyze_rr(rr)["bpm"]
+                else:
+                    bpm = float(message["bpm"])
+            except (ValueError, KeyError, TypeError):
+                await websocket.send_json({
+                    "type": "error",
+                    "detail": 'Expected {"bpm": number}, {"rr_intervals": [ms, ...]} or {"timestamps": [ms, ...]}'
+                })
+                continue
+            if not 30 <= bpm <= 220:
+                # Sensor glitch, not a heart rate
+                await websocket.send_json({"type": "error", "detail": "bpm must be between 30 and 220"})
+                continue
+            if user_id is not None:
+                await audio_service.record_heart_rate(user_id, bpm=bpm, rr_intervals=rr)
+            if session is None:
+                song = await music_service.session_song(bpm)
+                session = create_session(song, music_service.synthesizer, output, target_bpm)
+                tasks = [
+                    asyncio.create_task(_render_segments(websocket, session, segments, send_lock, tempo_known)),
+                    asyncio.create_task(_send_audio(websocket, session, segments, send_lock)),
+                ]
+            if session.add_sample(bpm):
+                async with send_lock:
+                    await websocket.send_json({"type": "tempo", **session.stats()})
+                tempo_known.set()
+            for task in tasks:
+                if task.done():
+                    task.result()
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        print(f"Heart-rate session failed: {e}")
+        print(traceback.format_exc())
+        await websocket.close(code=1011)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -1,7 +1,10 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, model_validator
+from typing import List, Optional
 
 class BPMUpdate(BaseModel):
     bpm: float = Field(..., ge=0, description="Beats per minute value")
+    user_id: Optional[str] = Field(None, max_length=128, description="Stores the reading in this user's heart-rate history")
+    timestamp: Optional[float] = Field(None, description="Unix time of the reading in seconds, now if omitted")
 
     class Config:
         json_schema_extra = {
@@ -10,8 +13,37 @@ class BPMUpdate(BaseModel):
             }
         }
 
+class HeartBeatBatch(BaseModel):
+    rr_intervals: Optional[List[float]] = Field(
+        None, max_length=100000, description="Intervals between consecutive beats in milliseconds"
+    )
+    timestamps: Optional[List[float]] = Field(
+        None, max_length=100000, description="Beat times in milliseconds, in order"
+    )
+    user_id: Optional[str] = Field(None, max_length=128, description="Stores the beats in this user's heart-rate history")
+    end_time: Optional[float] = Field(None, description="Unix time of the last beat in seconds, now if omitted")
+
+    @model_validator(mode="after")
+    def check_one_source(self):
+        if (self.rr_intervals is None) == (self.timestamps is None):
+            raise ValueError("Send either rr_intervals or timestamps")
+        return self
+
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "rr_intervals": [812, 798, 805, 1650, 790, 784]
+            }
+        }
+
 
 from pydantic import BaseModel, Field
+from typing import Literal, Optional
 
 class BPMRequest(BaseModel):
-    bpm: float = Field(..., ge=20, le=200, description="Beats per minute for the generated music")
\ No newline at end of file
+    bpm: float = Field(..., ge=20, le=200, description="Beats per minute for the generated music")
+    target_bpm: Optional[float] = Field(None, ge=20, le=200, description="BPM to glide towards, starting at bpm")
+    ramp_bars: int = Field(8, ge=1, le=64, description="Bars taken to reach target_bpm")
+    backend: Optional[Literal["gemini", "procedural"]] = Field(
+        None, description="Music generator, procedural is local and fast. Server default if omitted"
+    )
\ No newline at end of file
@@ -0,0 +1,101 @@
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+
+class AnalysisCache:
+    """
+    Bounded LRU cache with TTL for audio analysis results, keyed by content hash
+    and prompt version. Entries live in memory and are persisted to SQLite so
+    they survive restarts. Hits only reorder the memory LRU, their use times
+    are written in one batch every persist_seconds, on put and on flush.
+    """
+
+    def __init__(self, path: str, max_entries: int, ttl_seconds: float, persist_seconds: float = 60):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.persist_seconds = persist_seconds
+        self.entries: OrderedDict = OrderedDict()
+        self.used: Dict[str, float] = {}
+        self.last_persist = time.monotonic()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS analysis_cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, used_at REAL NOT NULL)"
+        )
+        self.db.execute("DELETE FROM analysis_cache WHERE expires_at <= ?", (time.time(),))
+        self.db.commit()
+        rows = self.db.execute(
+            "SELECT key, value, expires_at FROM analysis_cache ORDER BY used_at DESC LIMIT ?",
+            (max_entries,),
+        ).fetchall()
+        for key, value, expires_at in reversed(rows):
+            self.entries[key] = (expires_at, value)
+
+    def get(self, key: str) -> Optional[str]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] <= time.time():
+                if entry is not None:
+                    self._delete(key)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.used[key] = time.time()
+            if time.monotonic() - self.last_persist >= self.persist_seconds:
+                self._persist_used()
+                self.db.commit()
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: str, value: str):
+        now = time.time()
+        with self.lock:
+            self.entries[key] = (now + self.ttl_seconds, value)
+            self.entries.move_to_end(key)
+            self.db.execute(
+                "INSERT OR REPLACE INTO analysis_cache (key, value, expires_at, used_at) VALUES (?, ?, ?, ?)",
+                (key, value, now + self.ttl_seconds, now),
+            )
+            self.used.pop(key, None)
+            while len(self.entries) > self.max_entries:
+                oldest, _ = self.entries.popitem(last=False)
+                self.used.pop(oldest, None)
+                self.db.execute("DELETE FROM analysis_cache WHERE key = ?", (oldest,))
+            self._persist_used()
+            self.db.commit()
+
+    def _persist_used(self):
+        """Writes the use times of the hits since the last time, inside the caller's transaction."""
+        self.db.executemany("UPDATE analysis_cache SET used_at = ? WHERE key = ?",
+                            [(used_at, key) for key, used_at in self.used.items()])
+        self.used.clear()
+        self.last_persist = time.monotonic()
+
+    def flush(self):
+        """Writes the pending use times, so the LRU order survives a restart."""
+        with self.lock:
+            if self.used:
+                self._persist_used()
+                self.db.commit()
+
+    def _delete(self, key: str):
+        self.entries.pop(key, None)
+        self.used.pop(key, None)
+        self.db.execute("DELETE FROM analysis_cache WHERE key = ?", (key,))
+        self.db.commit()
+
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
@@ -0,0 +1,151 @@
+import os
+import asyncio
+import subprocess
+from dataclasses import dataclass, replace
+from typing import AsyncIterator, Optional, Tuple
+
+
+@dataclass(frozen=True)
+class Codec:
+    encoder: str
+    container: str
+    media_type: str
+    extension: str
+    default_bitrate: int  # kbps
+    sample_rates: Optional[Tuple[int, ...]] = None  # None when any rate works
+
+
+CODECS = {
+    "mp3": Codec("libmp3lame", "mp3", "audio/mpeg", "mp3", 128,
+                 (8000, 11025, 12000, 16000, 22050, 24000, 32000, 44100, 48000)),
+    "opus": Codec("libopus", "ogg", "audio/ogg", "ogg", 64, (8000, 12000, 16000, 24000, 48000)),
+    # ADTS instead of MP4 so AAC can be written to a pipe and streamed
+    "aac": Codec("aac", "adts", "audio/aac", "aac", 96),
+}
+
+
+@dataclass(frozen=True)
+class OutputFormat:
+    codec: str = "mp3"
+    sample_rate: int = 44100
+    bitrate: int = 128  # kbps
+    channels: int = 2
+
+    def __post_init__(self):
+        if self.codec not in CODECS:
+            raise ValueError(f"Unknown codec {self.codec!r}, expected one of {tuple(CODECS)}")
+        rates = CODECS[self.codec].sample_rates
+        if rates and self.sample_rate not in rates:
+            # Closest rate the codec supports that keeps the requested bandwidth
+            higher = [rate for rate in rates if rate >= self.sample_rate]
+            object.__setattr__(self, "sample_rate", higher[0] if higher else rates[-1])
+
+    @property
+    def media_type(self) -> str:
+        return CODECS[self.codec].media_type
+
+    @property
+    def extension(self) -> str:
+        return CODECS[self.codec].extension
+
+    @property
+    def tag(self) -> str:
+        """Encoder settings as a short string, used in cache keys."""
+        return f"{self.codec}-{self.sample_rate}hz-{self.bitrate}k-{self.channels}ch"
+
+    def with_changes(self, codec: str = None, sample_rate: int = None, bitrate: int = None,
+                     channels: int = None) -> "OutputFormat":
+        """Copy with the given settings, a new codec without a bitrate gets the codec default."""
+        if bitrate is None and codec not in (None, self.codec):
+            bitrate = CODECS[codec].default_bitrate
+        changes = {"codec": codec, "sample_rate": sample_rate, "bitrate": bitrate, "channels": channels}
+        return replace(self, **{key: value for key, value in changes.items() if value is not None})
+
+    def ffmpeg_args(self):
+        codec = CODECS[self.codec]
+        return [
+            "-c:a", codec.encoder, "-b:a", f"{self.bitrate}k",
+            "-ar", str(self.sample_rate), "-ac", str(self.channels), "-f", codec.container,
+        ]
+
+
+def create_output_format(sample_rate: int) -> OutputFormat:
+    """Default output format from the environment, sample_rate is the render sample rate."""
+    codec = os.getenv("MUSIC_OUTPUT_FORMAT", "mp3")
+    if codec not in CODECS:
+        raise ValueError(f"MUSIC_OUTPUT_FORMAT must be one of {tuple(CODECS)}")
+    return OutputFormat(
+        codec=codec,
+        sample_rate=int(os.getenv("MUSIC_OUTPUT_SAMPLE_RATE", str(sample_rate))),
+        bitrate=int(os.getenv("MUSIC_OUTPUT_BITRATE", str(CODECS[codec].default_bitrate))),
+        channels=int(os.getenv("MUSIC_OUTPUT_CHANNELS", "2")),
+    )
+
+
+def _ffmpeg_command(sample_rate: int, channels: int, output: OutputFormat, streaming: bool = False):
+    return [
+        "ffmpeg", "-hide_banner", "-loglevel", "error",
+        "-f", "s16le", "-ar", str(sample_rate), "-ac", str(channels), "-i", "pipe:0",
+        *output.ffmpeg_args(),
+        # Write every packet as soon as it is encoded instead of filling the output buffer
+        *(["-flush_packets", "1"] if streaming else []),
+        "pipe:1",
+    ]
+
+
+def encode(pcm: bytes, sample_rate: int, output: OutputFormat, channels: int = 2) -> bytes:
+    """Encodes a complete 16-bit PCM buffer in one ffmpeg run."""
+    result = subprocess.run(_ffmpeg_command(sample_rate, channels, output), input=pcm, capture_output=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed: {result.stderr.decode(errors='replace')}")
+    return result.stdout
+
+
+async def _feed(proc: asyncio.subprocess.Process, pcm_chunks: AsyncIterator[bytes]):
+    """Writes PCM chunks to the encoder as they are rendered."""
+    try:
+        async for chunk in pcm_chunks:
+            proc.stdin.write(chunk)
+            await proc.stdin.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        # The encoder was stopped, e.g. the client went away
+        pass
+    finally:
+        await pcm_chunks.aclose()
+        proc.stdin.close()
+
+
+async def stream_encode(pcm_chunks: AsyncIterator[bytes], sample_rate: int, output: OutputFormat,
+                        channels: int = 2, chunk_size: int = 16384) -> AsyncIterator[bytes]:
+    """
+    Encodes 16-bit PCM chunks with ffmpeg while they are still being rendered,
+    yielding encoded chunks as soon as the encoder outputs them. The pipes are
+    driven by the event loop, so no thread waits on a slow client.
+    """
+    proc = await asyncio.create_subprocess_exec(
+        *_ffmpeg_command(sample_rate, channels, output, streaming=True),
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    feeder = asyncio.create_task(_feed(proc, pcm_chunks))
+    try:
+        while chunk := await proc.stdout.read(chunk_size):
+            yield chunk
+        # Rendering errors surface here
+        await feeder
+        if await proc.wait() != 0:
+            raise RuntimeError(f"ffmpeg failed: {(await proc.stderr.read()).decode(errors='replace')}")
+    finally:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        feeder.cancel()
+        await asyncio.gather(feeder, return_exceptions=True)
+
+
+async def iter_bytes(data: bytes, chunk_size: int = 16384) -> AsyncIterator[bytes]:
+    """Yields an already encoded buffer in fixed-size chunks."""
+    for start in range(0, len(data), chunk_size):
+        yield data[start:start + chunk_size]
+
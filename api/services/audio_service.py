@@ -1,9 +1,20 @@
 from fastapi import UploadFile
 import os
-import google.generativeai as genai
-from typing import Dict, List
+import json
+import asyncio
+import time
+import hashlib
+import tempfile
+from typing import Dict, List, Optional
+from dataclasses import dataclass
 from pydantic import BaseModel
 from dotenv import load_dotenv
+from services import gemini_client
+from services.analysis_cache import AnalysisCache
+from services.diary_store import create_diary_store
+from services.executor import llm_executor, store_executor
+from services.heart_rate import analyze_rr, beat_samples, rr_from_timestamps
+from services.heart_rate_store import create_heart_rate_store
 
 load_dotenv()
 
@@ -20,12 +31,34 @@ VALID_TAGS = [
     "uncertainty"         # Doubts and unclear situations
 ]
 
+ANALYSIS_MODEL = "gemini-2.0-flash-exp"
+
+AUDIO_MIME_TYPES = {
+    ".ogg": "audio/ogg",
+    ".mp3": "audio/mp3",
+    ".wav": "audio/wav",
+    ".m4a": "audio/mp4",
+    ".mp4": "audio/mp4",
+}
+
+@dataclass
+class SpooledUpload:
+    """An upload read off the request, ready to be analyzed later."""
+    filename: str
+    mime_type: str
+    spool: tempfile.SpooledTemporaryFile
+    size: int
+    content_hash: str
+    user_id: Optional[str] = None
+
+    def close(self):
+        self.spool.close()
+
 class AudioService:
     def __init__(self):
-        self.upload_dir = "uploads"
-        os.makedirs(self.upload_dir, exist_ok=True)
-        
-        genai.configure(api_key=os.environ["GEMINI_API_KEY"])
+        # Notes up to this size are sent inline, bigger ones go through the File API
+        self.inline_max_bytes = int(os.getenv("AUDIO_INLINE_MAX_BYTES", str(4 * 1024 * 1024)))
+        self.chunk_size = 256 * 1024
         
         generation_config = {
             "temperature": 0.7,
@@ -35,14 +68,27 @@ class AudioService:
             "response_mime_type": "application/json",
         }
         
-        self.model = genai.GenerativeModel(
-            model_name="gemini-2.0-flash-exp",
+        self.model = gemini_client.get_model(
+            ANALYSIS_MODEL,
             generation_config=generation_config,
         )
+        
+        # Repeat uploads of the same note are answered from the cache while
+        # the model, its settings and the prompt stay the same
+        self.prompt_version = hashlib.sha256(
+            f"{ANALYSIS_MODEL}{sorted(generation_config.items())}{self._get_analysis_prompt()}".encode()
+        ).hexdigest()[:16]
+        self.cache = AnalysisCache(
+            os.getenv("ANALYSIS_CACHE_PATH", "analysis_cache.db"),
+            max_entries=int(os.getenv("ANALYSIS_CACHE_MAX_ENTRIES", "10000")),
+            ttl_seconds=float(os.getenv("ANALYSIS_CACHE_TTL_HOURS", "168")) * 3600,
+        )
+        self.heart_rate_store = create_heart_rate_store()
+        self.diary = create_diary_store()
     
-    def upload_to_gemini(self, path: str, mime_type: str = None):
-        """Uploads the given file to Gemini."""
-        file = genai.upload_file(path, mime_type=mime_type)
+    def upload_to_gemini(self, path, mime_type: str = None):
+        """Uploads the given file (path or binary file object) to Gemini."""
+        file = gemini_client.upload_file(path, mime_type=mime_type)
         print(f"Uploaded file '{file.display_name}' as: {file.uri}")
         return file
     
@@ -70,56 +116,202 @@ class AudioService:
         6. Ensure the output is valid JSON format
         """
         
-    async def save_audio(self, file: UploadFile) -> Dict:
+    async def spool_upload(self, file: UploadFile, user_id: str = None) -> SpooledUpload:
         """
-        Save the uploaded audio file and analyze it using Gemini.
+        Reads the upload in chunks into a spooled buffer that stays in memory
+        up to the inline threshold and spills to a unique temp file above it,
+        hashing the content on the way.
+        """
+        spool = tempfile.SpooledTemporaryFile(max_size=self.inline_max_bytes)
+        digest = hashlib.sha256()
+        while chunk := await file.read(self.chunk_size):
+            spool.write(chunk)
+            digest.update(chunk)
+        size = spool.tell()
+        spool.seek(0)
+        return SpooledUpload(file.filename, self._mime_type(file.filename), spool, size, digest.hexdigest(), user_id)
+
+    async def open_upload(self, file: UploadFile, user_id: str = None) -> SpooledUpload:
+        """
+        Uses the upload as Starlette already spooled it, only hashing it in
+        chunks, so the note is not copied. Valid while the request is handled,
+        queued uploads go through spool_upload.
+        """
+        digest = hashlib.sha256()
+        size = 0
+        await file.seek(0)
+        while chunk := await file.read(self.chunk_size):
+            digest.update(chunk)
+            size += len(chunk)
+        await file.seek(0)
+        return SpooledUpload(file.filename, self._mime_type(file.filename), file.file, size, digest.hexdigest(), user_id)
+
+    @staticmethod
+    def _mime_type(filename: str) -> str:
+        return AUDIO_MIME_TYPES.get(os.path.splitext(filename)[1].lower(), "audio/ogg")
+
+    async def _audio_part(self, upload: SpooledUpload):
+        """Inline bytes for small notes, an uploaded File API reference otherwise."""
+        if upload.size <= self.inline_max_bytes:
+            return {"mime_type": upload.mime_type, "data": upload.spool.read()}
+        return await llm_executor.run(self.upload_to_gemini, upload.spool, mime_type=upload.mime_type)
+
+    async def save_audio(self, file: UploadFile, user_id: str = None) -> Dict:
+        """
+        Analyze the uploaded audio file in place using Gemini.
         Returns transcript, classification, and identified irrational ideas.
         """
-        file_path = os.path.join(self.upload_dir, file.filename)
+        return await self.analyze_upload(await self.open_upload(file, user_id))
+
+    async def analyze_upload(self, upload: SpooledUpload) -> Dict:
+        """
+        Analyze an already spooled upload using Gemini, closing it afterwards.
+        Every analysis is stored in the diary, the response has its note_id.
+        """
+        cache_key = f"{upload.content_hash}:{self.prompt_version}"
         
         try:
-            content = await file.read()
-            with open(file_path, "wb") as f:
-                f.write(content)
+            analysis = await store_executor.run(self.cache.get, cache_key)
+            if analysis is not None:
+                return {
+                    "message": "Audio file processed successfully",
+                    "filename": upload.filename,
+                    "analysis": analysis,
+                    "cached": True,
+                    "note_id": await self._save_note(upload, analysis)
+                }
             
-            uploaded_file = self.upload_to_gemini(file_path, mime_type="audio/ogg")
+            audio_part = await self._audio_part(upload)
             
             chat_session = self.model.start_chat(
                 history=[
                     {
                         "role": "user",
                         "parts": [
-                            uploaded_file,
+                            audio_part,
                             self._get_analysis_prompt(),
                         ],
                     }
                 ]
             )
             
-            response = chat_session.send_message("Please analyze the audio content")
+            response = await llm_executor.call(
+                chat_session.send_message_async, "Please analyze the audio content"
+            )
             
             analysis = response.text
+            if self._is_json(analysis):
+                await store_executor.run(self.cache.put, cache_key, analysis)
             
             return {
                 "message": "Audio file processed successfully",
-                "filename": file.filename,
-                "analysis": analysis
+                "filename": upload.filename,
+                "analysis": analysis,
+                "cached": False,
+                "note_id": await self._save_note(upload, analysis)
             }
             
+        except asyncio.TimeoutError:
+            raise
         except Exception as e:
             raise Exception(f"Error processing audio file: {str(e)}")
         finally:
-            if os.path.exists(file_path):
-                os.remove(file_path)
-    
-    async def update_bpm(self, bpm: float) -> Dict:
+            upload.close()
+
+    async def _save_note(self, upload: SpooledUpload, analysis: str) -> Optional[int]:
+        """Stores the analysis in the diary, a note that cannot be stored does not fail the request."""
+        try:
+            parsed = json.loads(analysis)
+            if not isinstance(parsed, dict):
+                return None
+            return await store_executor.run(self.diary.add, parsed, upload.user_id, upload.filename, upload.content_hash)
+        except Exception as e:
+            print(f"Could not store diary note for {upload.filename}: {e}")
+            return None
+
+    async def diary_notes(self, **filters) -> Dict:
+        """Page of diary notes, newest first."""
+        try:
+            return await store_executor.run(self.diary.list, **filters)
+        except Exception as e:
+            raise Exception(f"Error reading diary notes: {str(e)}")
+
+    async def search_diary(self, query: str, **filters) -> Dict:
+        """
+        Page of diary notes matching query, newest first.
+        Raises ValueError when the query has no words.
+        """
+        try:
+            return await store_executor.run(self.diary.search, query, **filters)
+        except ValueError:
+            raise
+        except Exception as e:
+            raise Exception(f"Error searching diary notes: {str(e)}")
+
+    async def diary_summary(self, start: float, end: float, user_id: str = None,
+                            interval: str = "day", top: int = 10) -> Dict:
+        """
+        Notes per classification and most frequent irrational ideas,
+        from the precomputed daily rollups.
+        """
+        try:
+            return await store_executor.run(self.diary.summary, start, end, user_id, interval, top)
+        except Exception as e:
+            raise Exception(f"Error reading diary summary: {str(e)}")
+
+    @staticmethod
+    def _is_json(text: str) -> bool:
+        try:
+            json.loads(text)
+            return True
+        except json.JSONDecodeError:
+            return False
+
+    async def update_bpm(self, bpm: float, user_id: str = None, timestamp: float = None) -> Dict:
         """
         Update BPM information.
         """
         try:
+            if user_id is not None:
+                await self.record_heart_rate(user_id, bpm=bpm, timestamp=timestamp)
             return {
                 "message": "BPM updated successfully",
                 "bpm": bpm
             }
         except Exception as e:
-            raise Exception(f"Error updating BPM: {str(e)}")
\ No newline at end of file
+            raise Exception(f"Error updating BPM: {str(e)}")
+
+    async def analyze_heart_rate(self, rr_intervals: List[float] = None, timestamps: List[float] = None,
+                                 user_id: str = None, end_time: float = None) -> Dict:
+        """
+        Smoothed BPM, trend and variability of a batch of beats.
+        Raises ValueError when the batch has too few valid beats.
+        """
+        rr = rr_from_timestamps(timestamps) if rr_intervals is None else rr_intervals
+        result = analyze_rr(rr)
+        if user_id is not None:
+            await self.record_heart_rate(user_id, rr_intervals=rr, timestamp=end_time)
+        result["message"] = "Heart rate analyzed successfully"
+        return result
+
+    async def record_heart_rate(self, user_id: str, bpm: float = None, rr_intervals=None, timestamp: float = None):
+        """
+        Stores a single reading, or every valid beat of a batch of RR intervals
+        ending at timestamp, in the user's heart-rate history.
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        if rr_intervals is not None:
+            times, values = beat_samples(rr_intervals, timestamp)
+        else:
+            times, values = [timestamp], [bpm]
+        await store_executor.run(self.heart_rate_store.add, user_id, times, values)
+
+    async def heart_rate_history(self, user_id: str, start: float, end: float, resolution: str = "auto") -> Dict:
+        """
+        Heart rate of a user between start and end (unix seconds): raw samples
+        while they are still buffered, per-minute or per-hour rollups otherwise.
+        """
+        try:
+            return await store_executor.run(self.heart_rate_store.query, user_id, start, end, resolution)
+        except Exception as e:
+            raise Exception(f"Error reading heart rate history: {str(e)}")
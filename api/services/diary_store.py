@@ -0,0 +1,313 @@
+import os
+import re
+import time
+import sqlite3
+import threading
+from collections import Counter
+from typing import Dict, List, Optional
+
+NOTE_COLUMNS = "id, user_id, created_at, filename, classification, transcript"
+
+SEARCH_FIELDS = {"all": None, "transcript": "transcript", "ideas": "idea_titles"}
+
+DAY_SECONDS = 86400
+
+# Rollup buckets as SQL over the day column, weeks start on Monday (1970-01-01 was a Thursday)
+SUMMARY_INTERVALS = {"day": "day", "week": f"day - ((day / {DAY_SECONDS} + 3) % 7) * {DAY_SECONDS}"}
+
+UNCLASSIFIED = "unclassified"
+
+
+def idea_key(title: str) -> str:
+    """Irrational-idea titles are counted together regardless of case and spacing."""
+    return " ".join(title.split()).casefold()
+
+
+def match_expression(query: str, field: str = "all") -> str:
+    """
+    FTS5 query matching every word of a free-text query, in any order.
+    A trailing * makes a word a prefix. Raises ValueError without words.
+    """
+    words = re.findall(r"\w+\*?", query)
+    if not words:
+        raise ValueError("The search query has no words")
+    terms = " ".join(f'"{word.rstrip("*")}"' + ("*" if word.endswith("*") else "") for word in words)
+    column = SEARCH_FIELDS[field]
+    return f"{{{column}}} : ({terms})" if column else terms
+
+
+class DiaryStore:
+    """
+    Diary notes with their analysis, in SQLite. Notes are indexed by user,
+    classification and time, transcripts and irrational-idea titles are
+    full-text indexed with FTS5. Notes get created_at when stored, so ids
+    follow time order: pages are walked newest first with the id of the last
+    note as cursor, and time ranges become id ranges. Daily counts per user
+    of classifications and irrational ideas are kept up to date in rollup
+    tables as notes are added, for the summaries. A user's repeat upload of
+    the same audio is the same note, kept once.
+    """
+
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(
+            "CREATE TABLE IF NOT EXISTS notes ("
+            "id INTEGER PRIMARY KEY, user_id TEXT, created_at REAL NOT NULL, filename TEXT, "
+            "content_hash TEXT, classification TEXT, transcript TEXT NOT NULL, idea_titles TEXT NOT NULL);"
+            "CREATE UNIQUE INDEX IF NOT EXISTS notes_user_content ON notes (IFNULL(user_id, ''), content_hash) "
+            "WHERE content_hash IS NOT NULL;"
+            "CREATE INDEX IF NOT EXISTS notes_user ON notes (user_id, id);"
+            "CREATE INDEX IF NOT EXISTS notes_user_classification ON notes (user_id, classification, id);"
+            "CREATE INDEX IF NOT EXISTS notes_classification ON notes (classification, id);"
+            "CREATE INDEX IF NOT EXISTS notes_created_at ON notes (created_at);"
+            "CREATE TABLE IF NOT EXISTS irrational_ideas ("
+            "note_id INTEGER NOT NULL, position INTEGER NOT NULL, title TEXT NOT NULL, description TEXT NOT NULL, "
+            "PRIMARY KEY (note_id, position)) WITHOUT ROWID;"
+            "CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5("
+            "transcript, idea_titles, content='notes', content_rowid='id', "
+            "tokenize='unicode61 remove_diacritics 2');"
+            "CREATE TABLE IF NOT EXISTS classification_rollups ("
+            "user_id TEXT NOT NULL, day INTEGER NOT NULL, classification TEXT NOT NULL, count INTEGER NOT NULL, "
+            "PRIMARY KEY (user_id, day, classification)) WITHOUT ROWID;"
+            "CREATE INDEX IF NOT EXISTS classification_rollups_day ON classification_rollups (day);"
+            "CREATE TABLE IF NOT EXISTS idea_rollups ("
+            "user_id TEXT NOT NULL, day INTEGER NOT NULL, idea_key TEXT NOT NULL, title TEXT NOT NULL, "
+            "count INTEGER NOT NULL, PRIMARY KEY (user_id, day, idea_key)) WITHOUT ROWID;"
+            "CREATE INDEX IF NOT EXISTS idea_rollups_day ON idea_rollups (day);"
+        )
+        self.db.commit()
+        self._backfill_rollups()
+
+    def _backfill_rollups(self):
+        """Builds the rollups from the stored notes when they are missing, e.g. on a diary written before them."""
+        if self.db.execute("SELECT 1 FROM classification_rollups LIMIT 1").fetchone():
+            return
+        if not self.db.execute("SELECT 1 FROM notes LIMIT 1").fetchone():
+            return
+        notes = self.db.execute(
+            "SELECT n.user_id, n.created_at, n.classification, group_concat(i.title, char(10)) "
+            "FROM notes n LEFT JOIN irrational_ideas i ON i.note_id = n.id GROUP BY n.id"
+        )
+        with self.db:
+            for user_id, created_at, classification, titles in notes:
+                self._add_rollups(user_id, created_at, classification, titles.split("\n") if titles else [])
+
+    def _find(self, user_id: Optional[str], content_hash: Optional[str]) -> Optional[int]:
+        if content_hash is None:
+            return None
+        row = self.db.execute(
+            "SELECT id FROM notes WHERE IFNULL(user_id, '') = ? AND content_hash = ? AND content_hash IS NOT NULL",
+            (user_id or "", content_hash),
+        ).fetchone()
+        return row[0] if row else None
+
+    def add(self, analysis: Dict, user_id: str = None, filename: str = None, content_hash: str = None) -> int:
+        """
+        Stores an analyzed note, returns its id. A note of audio the user
+        already sent is not stored again, the id of the first one is returned.
+        """
+        transcript = str(analysis.get("transcript") or "")
+        ideas = [
+            (str(idea.get("title") or ""), str(idea.get("description") or ""))
+            for idea in analysis.get("irrational_ideas") or [] if isinstance(idea, dict)
+        ]
+        idea_titles = "\n".join(title for title, _ in ideas)
+        classification = analysis.get("classification")
+        with self.lock:
+            note_id = self._find(user_id, content_hash)
+            if note_id is not None:
+                return note_id
+            try:
+                with self.db:
+                    created_at = time.time()
+                    note_id = self.db.execute(
+                        "INSERT INTO notes (user_id, created_at, filename, content_hash, classification, transcript, idea_titles) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (user_id, created_at, filename, content_hash, classification, transcript, idea_titles),
+                    ).lastrowid
+                    self.db.executemany(
+                        "INSERT INTO irrational_ideas (note_id, position, title, description) VALUES (?, ?, ?, ?)",
+                        [(note_id, position, title, description) for position, (title, description) in enumerate(ideas)],
+                    )
+                    self.db.execute(
+                        "INSERT INTO notes_fts (rowid, transcript, idea_titles) VALUES (?, ?, ?)",
+                        (note_id, transcript, idea_titles),
+                    )
+                    self._add_rollups(user_id, created_at, classification, [title for title, _ in ideas])
+            except sqlite3.IntegrityError:
+                # Stored meanwhile by another worker sharing the file
+                note_id = self._find(user_id, content_hash)
+                if note_id is None:
+                    raise
+        return note_id
+
+    def _add_rollups(self, user_id: Optional[str], created_at: float, classification: Optional[str],
+                     titles: List[str]):
+        """Counts one note in the daily rollups, inside the caller's transaction."""
+        user_id = user_id or ""
+        day = int(created_at // DAY_SECONDS) * DAY_SECONDS
+        self.db.execute(
+            "INSERT INTO classification_rollups (user_id, day, classification, count) VALUES (?, ?, ?, 1) "
+            "ON CONFLICT (user_id, day, classification) DO UPDATE SET count = count + 1",
+            (user_id, day, classification or UNCLASSIFIED),
+        )
+        # An idea counts once per note, however many times the note names it
+        first_titles = {}
+        for title in titles:
+            if title.strip():
+                first_titles.setdefault(idea_key(title), " ".join(title.split()))
+        self.db.executemany(
+            "INSERT INTO idea_rollups (user_id, day, idea_key, title, count) VALUES (?, ?, ?, ?, 1) "
+            "ON CONFLICT (user_id, day, idea_key) DO UPDATE SET count = count + 1",
+            [(user_id, day, key, title) for key, title in first_titles.items()],
+        )
+
+    def _id_range(self, start: Optional[float], end: Optional[float]):
+        """Ids of the first and last note with start <= created_at < end, None when there are none."""
+        low, high = 0, 2 ** 63 - 1
+        if start is not None:
+            row = self.db.execute(
+                "SELECT id FROM notes WHERE created_at >= ? ORDER BY created_at LIMIT 1", (start,)
+            ).fetchone()
+            if row is None:
+                return None
+            low = row[0]
+        if end is not None:
+            row = self.db.execute(
+                "SELECT id FROM notes WHERE created_at < ? ORDER BY created_at DESC LIMIT 1", (end,)
+            ).fetchone()
+            if row is None:
+                return None
+            high = row[0]
+        return (low, high) if low <= high else None
+
+    def _notes(self, rows: List[tuple]) -> List[Dict]:
+        ideas: Dict[int, List[Dict]] = {row[0]: [] for row in rows}
+        if rows:
+            for note_id, title, description in self.db.execute(
+                f"SELECT note_id, title, description FROM irrational_ideas "
+                f"WHERE note_id IN ({','.join('?' * len(rows))}) ORDER BY note_id, position",
+                list(ideas),
+            ):
+                ideas[note_id].append({"title": title, "description": description})
+        return [
+            {
+                "id": row[0],
+                "user_id": row[1],
+                "created_at": row[2],
+                "filename": row[3],
+                "classification": row[4],
+                "transcript": row[5],
+                "irrational_ideas": ideas[row[0]],
+            }
+            for row in rows
+        ]
+
+    def _page(self, select: str, id_column: str, filters: List[str], params: list,
+              start: Optional[float], end: Optional[float], cursor: Optional[int], limit: int) -> Dict:
+        with self.lock:
+            ids = self._id_range(start, end)
+            if ids is None:
+                return {"notes": [], "next_cursor": None}
+            if cursor is not None:
+                ids = (ids[0], min(ids[1], cursor - 1))
+            rows = self.db.execute(
+                f"{select} WHERE {' AND '.join(filters + [f'{id_column} BETWEEN ? AND ?'])} "
+                f"ORDER BY {id_column} DESC LIMIT ?",
+                params + [ids[0], ids[1], limit + 1],
+            ).fetchall()
+            notes = self._notes(rows[:limit])
+        for note, row in zip(notes, rows):
+            if len(row) > 6:
+                note["snippet"] = row[6]
+        return {"notes": notes, "next_cursor": notes[-1]["id"] if len(rows) > limit else None}
+
+    def list(self, user_id: str = None, classification: str = None, start: float = None, end: float = None,
+             cursor: int = None, limit: int = 20) -> Dict:
+        """Notes newest first, next_cursor is passed back as cursor for the next page."""
+        filters, params = [], []
+        if user_id is not None:
+            filters.append("user_id = ?")
+            params.append(user_id)
+        if classification is not None:
+            filters.append("classification = ?")
+            params.append(classification)
+        return self._page(f"SELECT {NOTE_COLUMNS} FROM notes", "id", filters, params, start, end, cursor, limit)
+
+    def search(self, query: str, field: str = "all", user_id: str = None, classification: str = None,
+               start: float = None, end: float = None, cursor: int = None, limit: int = 20) -> Dict:
+        """
+        Notes matching every word of query in field (all, transcript or
+        ideas), newest first, each with a snippet of the match.
+        """
+        filters, params = ["notes_fts MATCH ?"], [match_expression(query, field)]
+        if user_id is not None:
+            filters.append("n.user_id = ?")
+            params.append(user_id)
+        if classification is not None:
+            filters.append("n.classification = ?")
+            params.append(classification)
+        select = (
+            f"SELECT {', '.join('n.' + column for column in NOTE_COLUMNS.split(', '))}, "
+            "snippet(notes_fts, -1, '[', ']', '...', 16) "
+            "FROM notes_fts JOIN notes n ON n.id = notes_fts.rowid"
+        )
+        return self._page(select, "notes_fts.rowid", filters, params, start, end, cursor, limit)
+
+    def get(self, note_id: int) -> Optional[Dict]:
+        with self.lock:
+            rows = self.db.execute(f"SELECT {NOTE_COLUMNS} FROM notes WHERE id = ?", (note_id,)).fetchall()
+            notes = self._notes(rows)
+        return notes[0] if notes else None
+
+    def summary(self, start: float, end: float, user_id: str = None, interval: str = "day", top: int = 10) -> Dict:
+        """
+        Notes per classification and most frequent irrational ideas between
+        start and end, read from the daily rollups only. start and end are
+        rounded to whole days (UTC). The series has the classification counts
+        of every day or week with notes.
+        """
+        filters = ["day >= ?", "day < ?"]
+        params = [int(start // DAY_SECONDS) * DAY_SECONDS, end]
+        if user_id is not None:
+            filters.append("user_id = ?")
+            params.append(user_id)
+        where = " AND ".join(filters)
+        bucket = SUMMARY_INTERVALS[interval]
+        with self.lock:
+            rows = self.db.execute(
+                f"SELECT {bucket} AS bucket, classification, SUM(count) FROM classification_rollups "
+                f"WHERE {where} GROUP BY bucket, classification ORDER BY bucket",
+                params,
+            ).fetchall()
+            ideas = self.db.execute(
+                f"SELECT MIN(title), SUM(count) AS total FROM idea_rollups WHERE {where} "
+                f"GROUP BY idea_key ORDER BY total DESC, idea_key LIMIT ?",
+                params + [top],
+            ).fetchall()
+        classifications = Counter()
+        series: Dict[int, Dict[str, int]] = {}
+        for bucket_start, classification, count in rows:
+            classifications[classification] += count
+            series.setdefault(bucket_start, {})[classification] = count
+        return {
+            "user_id": user_id,
+            "start": start,
+            "end": end,
+            "interval": interval,
+            "notes": sum(classifications.values()),
+            "classifications": dict(classifications.most_common()),
+            "series": [{"t": bucket_start, "counts": counts} for bucket_start, counts in series.items()],
+            "top_irrational_ideas": [{"title": title, "count": count} for title, count in ideas],
+        }
+
+    def stats(self) -> Dict:
+        with self.lock:
+            notes, users = self.db.execute("SELECT COUNT(*), COUNT(DISTINCT user_id) FROM notes").fetchone()
+        return {"notes": notes, "users": users}
+
+
+def create_diary_store() -> DiaryStore:
+    return DiaryStore(os.getenv("DIARY_DB_PATH", "diary.db"))
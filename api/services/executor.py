@@ -0,0 +1,47 @@
+import os
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+
+class BoundedExecutor:
+    """
+    Keeps slow calls off the event loop.
+    At most max_concurrency calls run at once, the rest wait their turn,
+    and each call is abandoned with asyncio.TimeoutError after timeout seconds.
+    """
+
+    def __init__(self, name: str, max_concurrency: int, timeout: float):
+        self.name = name
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.pool = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix=name)
+
+    async def run(self, fn, *args, **kwargs):
+        """Runs a blocking function on the executor threads."""
+        async with self.semaphore:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self.pool, functools.partial(fn, *args, **kwargs))
+            return await asyncio.wait_for(future, self.timeout)
+
+    async def call(self, fn, *args, **kwargs):
+        """Awaits a coroutine function under the same limits."""
+        async with self.semaphore:
+            return await asyncio.wait_for(fn(*args, **kwargs), self.timeout)
+
+
+def create_executor(name: str, default_concurrency: int, default_timeout: float) -> BoundedExecutor:
+    prefix = name.upper()
+    return BoundedExecutor(
+        name,
+        max_concurrency=int(os.getenv(f"{prefix}_MAX_CONCURRENCY", str(default_concurrency))),
+        timeout=float(os.getenv(f"{prefix}_TIMEOUT_SECONDS", str(default_timeout))),
+    )
+
+
+# Shared by every service calling Gemini, so the limit applies per worker
+llm_executor = create_executor("llm", 32, 300)
+render_executor = create_executor("render", os.cpu_count() or 4, 120)
+# SQLite reads and writes of the heart-rate and diary stores
+store_executor = create_executor("store", 4, 30)
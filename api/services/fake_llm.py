@@ -0,0 +1,180 @@
+import os
+import json
+import random
+import asyncio
+from types import SimpleNamespace
+from typing import List
+
+# Canned analyses, answered by models asked for JSON
+ANALYSES = [
+    {
+        "transcript": "Tomorrow is the exam and I know I am going to fail, I always fail when it matters.",
+        "classification": "anxiety_expression",
+        "irrational_ideas": [
+            {"title": "Catastrophizing", "description": "One exam is taken as a certain disaster before it happens."},
+            {"title": "Overgeneralization", "description": "Past results are turned into an 'always'."},
+        ],
+    },
+    {
+        "transcript": "I should have finished the report yesterday, I am useless at work.",
+        "classification": "self_criticism",
+        "irrational_ideas": [
+            {"title": "Should statements", "description": "A rigid rule about what must have been done."},
+            {"title": "Labeling", "description": "A missed deadline becomes a judgement of the whole person."},
+        ],
+    },
+    {
+        "transcript": "Today I walked in the park with my sister and I am thankful for her.",
+        "classification": "gratitude",
+        "irrational_ideas": [],
+    },
+    {
+        "transcript": "My friend did not answer my message, she must be angry with me.",
+        "classification": "interpersonal",
+        "irrational_ideas": [
+            {"title": "Mind reading", "description": "Assumes what the friend thinks without evidence."},
+        ],
+    },
+]
+
+
+class Latency:
+    """
+    Latency distribution in milliseconds, from a spec like fixed:500,
+    uniform:200,800, normal:500,100 or lognormal:500,0.4 (median, sigma).
+    """
+
+    def __init__(self, spec: str, rng: random.Random):
+        self.spec = spec
+        self.rng = rng
+        kind, _, params = spec.partition(":")
+        self.kind = kind.strip()
+        self.params = [float(param) for param in params.split(",") if param.strip()]
+        expected = {"fixed": 1, "uniform": 2, "normal": 2, "lognormal": 2}
+        if expected.get(self.kind) != len(self.params):
+            raise ValueError(f"Invalid latency '{spec}', use fixed:ms, uniform:lo,hi, normal:mean,std or lognormal:median,sigma")
+
+    def sample(self) -> float:
+        """A latency in seconds, never negative."""
+        if self.kind == "fixed":
+            ms = self.params[0]
+        elif self.kind == "uniform":
+            ms = self.rng.uniform(*self.params)
+        elif self.kind == "normal":
+            ms = self.rng.gauss(*self.params)
+        else:
+            ms = self.params[0] * self.rng.lognormvariate(0, self.params[1])
+        return max(0.0, ms) / 1000
+
+
+class FakeResponse:
+    """Stands in for a Gemini response, iterable in chunks when streamed."""
+
+    def __init__(self, text: str, prompt_tokens: int, chunks: List[str], chunk_latency: Latency):
+        self.text = text
+        self.chunks = chunks
+        self.chunk_latency = chunk_latency
+        self.usage_metadata = SimpleNamespace(
+            prompt_token_count=prompt_tokens,
+            cached_content_token_count=0,
+            candidates_token_count=len(text) // 4,
+            total_token_count=prompt_tokens + len(text) // 4,
+        )
+
+    async def __aiter__(self):
+        for index, chunk in enumerate(self.chunks):
+            if index:
+                await asyncio.sleep(self.chunk_latency.sample())
+            yield SimpleNamespace(text=chunk, parts=[SimpleNamespace(text=chunk)])
+
+
+class FakeChat:
+    def __init__(self, model: "FakeModel", history):
+        self.model = model
+        self.prompt_chars = len(model.system_instruction or "") + sum(
+            len(part) for message in history or [] for part in message.get("parts", []) if isinstance(part, str)
+        )
+
+    async def send_message_async(self, content, stream: bool = False):
+        backend = self.model.backend
+        await asyncio.sleep(backend.latency.sample())
+        if backend.rng.random() < backend.error_rate:
+            raise RuntimeError("Fake LLM error")
+        text = self.model.answer()
+        chunks = [text]
+        if stream:
+            size = -(-len(text) // backend.stream_chunks)
+            chunks = [text[start:start + size] for start in range(0, len(text), size)]
+        prompt_tokens = (self.prompt_chars + len(str(content))) // 4
+        return FakeResponse(text, prompt_tokens, chunks, backend.chunk_latency)
+
+
+class FakeModel:
+    """
+    Stands in for a GenerativeModel. Models asked for JSON answer with a
+    canned voice-note analysis, the others with one of the example songs.
+    """
+
+    def __init__(self, backend: "FakeBackend", model_name: str, generation_config: dict = None,
+                 system_instruction: str = None):
+        self.backend = backend
+        self.model_name = model_name
+        self.generation_config = generation_config or {}
+        self.system_instruction = system_instruction
+
+    def answer(self) -> str:
+        if self.generation_config.get("response_mime_type") == "application/json":
+            return json.dumps(self.backend.rng.choice(ANALYSES))
+        return self.backend.rng.choice(self.backend.songs())
+
+    def start_chat(self, history=None) -> FakeChat:
+        return FakeChat(self, history)
+
+    async def count_tokens_async(self, contents):
+        return SimpleNamespace(total_tokens=len(str(contents)) // 4)
+
+
+class FakeBackend:
+    """
+    Local stand-in for the Gemini API, to measure the service without it.
+    Every call waits a latency drawn from its distribution, streamed
+    responses arrive in stream_chunks chunks with chunk_latency between them.
+    """
+
+    def __init__(self, latency: str, chunk_latency: str, stream_chunks: int, error_rate: float,
+                 song_paths: List[str], seed: int = None):
+        self.rng = random.Random(seed)
+        self.latency = Latency(latency, self.rng)
+        self.chunk_latency = Latency(chunk_latency, self.rng)
+        self.stream_chunks = max(1, stream_chunks)
+        self.error_rate = error_rate
+        self.song_paths = song_paths
+        self._songs = None
+
+    def songs(self) -> List[str]:
+        if self._songs is None:
+            songs = []
+            for path in self.song_paths:
+                with open(path, "r") as f:
+                    songs.append(json.dumps(json.load(f), separators=(",", ":")))
+            self._songs = songs
+        return self._songs
+
+    def get_model(self, model_name: str, generation_config: dict = None,
+                  system_instruction: str = None) -> FakeModel:
+        return FakeModel(self, model_name, generation_config, system_instruction)
+
+    def upload_file(self, path, mime_type: str = None):
+        return SimpleNamespace(display_name="fake-upload", uri="fake://upload", mime_type=mime_type)
+
+
+def create_fake_backend() -> FakeBackend:
+    seed = os.getenv("FAKE_LLM_SEED")
+    return FakeBackend(
+        latency=os.getenv("FAKE_LLM_LATENCY_MS", "lognormal:800,0.4"),
+        chunk_latency=os.getenv("FAKE_LLM_CHUNK_LATENCY_MS", "fixed:40"),
+        stream_chunks=int(os.getenv("FAKE_LLM_STREAM_CHUNKS", "20")),
+        error_rate=float(os.getenv("FAKE_LLM_ERROR_RATE", "0")),
+        song_paths=os.getenv("FAKE_LLM_SONGS", "calm.json,calm2.json,rivers.json").split(","),
+        seed=int(seed) if seed else None,
+    )
@@ -0,0 +1,97 @@
+import os
+import json
+import threading
+import google.generativeai as genai
+from dotenv import load_dotenv
+
+load_dotenv()
+
+BACKENDS = ("gemini", "fake")
+
+_lock = threading.Lock()
+_configured = False
+_models = {}
+_fake = None
+
+
+def is_fake() -> bool:
+    """True when LLM_BACKEND=fake, the local stand-in answers instead of Gemini."""
+    backend = os.getenv("LLM_BACKEND", "gemini")
+    if backend not in BACKENDS:
+        raise ValueError(f"LLM_BACKEND must be one of {BACKENDS}")
+    return backend == "fake"
+
+
+def _fake_backend():
+    global _fake
+    with _lock:
+        if _fake is None:
+            from services.fake_llm import create_fake_backend
+            _fake = create_fake_backend()
+        return _fake
+
+
+def configure():
+    """
+    Configures the Gemini SDK once per process. Calling genai.configure again
+    would drop the SDK's shared clients and their open connections.
+    """
+    global _configured
+    if is_fake():
+        return
+    with _lock:
+        if not _configured:
+            genai.configure(api_key=os.environ["GEMINI_API_KEY"])
+            _configured = True
+
+
+def _config_key(generation_config) -> str:
+    return json.dumps(generation_config or {}, sort_keys=True)
+
+
+def get_model(model_name: str, generation_config: dict = None,
+              system_instruction: str = None) -> genai.GenerativeModel:
+    """
+    Returns a shared GenerativeModel for these settings, created on first use.
+    Models are safe to share between requests, chat sessions are not.
+    """
+    configure()
+    key = (model_name, _config_key(generation_config), system_instruction)
+    fake = _fake_backend() if is_fake() else None
+    with _lock:
+        if key not in _models and fake is not None:
+            _models[key] = fake.get_model(model_name, generation_config, system_instruction)
+        elif key not in _models:
+            _models[key] = genai.GenerativeModel(
+                model_name=model_name,
+                generation_config=generation_config,
+                system_instruction=system_instruction,
+            )
+        return _models[key]
+
+
+def upload_file(path, mime_type: str = None):
+    """Uploads a file (path or binary file object) through the Gemini File API."""
+    if is_fake():
+        return _fake_backend().upload_file(path, mime_type)
+    configure()
+    return genai.upload_file(path, mime_type=mime_type)
+
+
+def get_cached_model(cached_content, generation_config: dict = None) -> genai.GenerativeModel:
+    """Returns a shared GenerativeModel bound to a context cache."""
+    configure()
+    key = ("cached", cached_content.name, _config_key(generation_config))
+    with _lock:
+        if key not in _models:
+            _models[key] = genai.GenerativeModel.from_cached_content(
+                cached_content, generation_config=generation_config
+            )
+        return _models[key]
+
+
+def forget_cached_model(cached_content):
+    """Drops models bound to a context cache that was deleted or expired."""
+    with _lock:
+        for key in [key for key in _models if key[0] == "cached" and key[1] == cached_content.name]:
+            del _models[key]
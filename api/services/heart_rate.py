@@ -0,0 +1,75 @@
+import numpy as np
+from typing import Dict, Sequence
+
+from numpy.lib.stride_tricks import sliding_window_view
+
+# RR intervals outside 30-220 BPM are sensor glitches, not heart beats
+MIN_RR_MS = 60000 / 220
+MAX_RR_MS = 60000 / 30
+
+
+def rr_from_timestamps(timestamps_ms: Sequence[float]) -> np.ndarray:
+    """RR intervals in milliseconds between consecutive beat timestamps."""
+    return np.diff(np.asarray(timestamps_ms, dtype=np.float64))
+
+
+def _rolling(values: np.ndarray, window: int, fn) -> np.ndarray:
+    """Centered rolling statistic, edges padded with the edge values."""
+    half = window // 2
+    padded = np.pad(values, (half, window - 1 - half), mode="edge")
+    return fn(sliding_window_view(padded, window), axis=1)
+
+
+def valid_beats(rr: np.ndarray, window: int = 5, max_deviation: float = 0.2) -> np.ndarray:
+    """
+    Mask of the RR intervals to keep: inside physiological bounds and at most
+    max_deviation away from the median of their neighbours.
+    """
+    valid = (rr >= MIN_RR_MS) & (rr <= MAX_RR_MS)
+    if valid.sum() >= window:
+        local = _rolling(rr[valid], window, np.median)
+        keep = np.abs(rr[valid] - local) <= max_deviation * local
+        valid[np.flatnonzero(valid)[~keep]] = False
+    return valid
+
+
+def beat_samples(rr_ms: Sequence[float], end_time: float):
+    """
+    Instantaneous BPM of every valid beat and its time in unix seconds,
+    for beats ending at end_time.
+    """
+    rr = np.asarray(rr_ms, dtype=np.float64)
+    valid = valid_beats(rr)
+    elapsed = np.cumsum(np.where(rr > 0, rr, 0)) / 1000
+    times = end_time - (elapsed[-1] - elapsed) if len(rr) else elapsed
+    return times[valid], 60000 / rr[valid]
+
+
+def analyze_rr(rr_ms: Sequence[float], window: int = 5, max_deviation: float = 0.2) -> Dict:
+    """
+    Heart rate summary of a batch of RR intervals (milliseconds), in one
+    vectorized pass. Intervals outside physiological bounds, or more than
+    max_deviation away from the median of their neighbours, are rejected.
+    The rest give a median-then-mean smoothed BPM, its trend in BPM per
+    minute and the usual variability measures (RMSSD and SDNN).
+    """
+    rr = np.asarray(rr_ms, dtype=np.float64)
+    valid = valid_beats(rr, window, max_deviation)
+    clean = rr[valid]
+    if len(clean) < 2:
+        raise ValueError("At least 2 valid beat intervals are needed")
+
+    bpm = 60000 / clean
+    smoothed = _rolling(_rolling(bpm, window, np.median), window, np.mean)
+    # Beat times in minutes, from the raw intervals so rejected beats keep their time
+    minutes = np.cumsum(np.where(rr > 0, rr, 0))[valid] / 60000
+    trend = np.polyfit(minutes, bpm, 1)[0] if len(clean) >= 3 and np.ptp(minutes) > 0 else 0.0
+    return {
+        "bpm": round(float(smoothed[-1]), 2),
+        "mean_bpm": round(float(bpm.mean()), 2),
+        "trend_bpm_per_minute": round(float(trend), 2) + 0.0,  # no -0.0
+        "rmssd_ms": round(float(np.sqrt(np.mean(np.diff(clean) ** 2))), 2),
+        "sdnn_ms": round(float(clean.std(ddof=1)), 2),
+        "beats": int(len(rr)),
+        "rejected": int(len(rr) - len(clean)),
+    }
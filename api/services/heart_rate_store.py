@@ -0,0 +1,231 @@
+import os
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import numpy as np
+
+ROLLUP_SECONDS = {"minute": 60, "hour": 3600}
+
+
+class RingBuffer:
+    """
+    Fixed-size array-backed buffer of the most recent (time, bpm) samples.
+    Samples are kept in time order, so range lookups are binary searches.
+    """
+
+    def __init__(self, capacity: int):
+        self.times = np.zeros(capacity, dtype=np.float64)
+        self.values = np.zeros(capacity, dtype=np.float32)
+        self.start = 0
+        self.size = 0
+
+    @property
+    def capacity(self) -> int:
+        return len(self.times)
+
+    def _segments(self):
+        # The buffer content in time order, as at most two contiguous slices
+        end = self.start + self.size
+        if end <= self.capacity:
+            return [slice(self.start, end)]
+        return [slice(self.start, self.capacity), slice(0, end - self.capacity)]
+
+    @property
+    def oldest(self) -> Optional[float]:
+        return float(self.times[self.start]) if self.size else None
+
+    @property
+    def newest(self) -> Optional[float]:
+        return float(self.times[(self.start + self.size - 1) % self.capacity]) if self.size else None
+
+    def extend(self, times: np.ndarray, values: np.ndarray):
+        """
+        Adds samples in time order. Late samples, e.g. a back-dated batch, are
+        merged among the kept ones, only the tail newer than the earliest of
+        them is rewritten. The oldest samples go when the buffer is full.
+        """
+        if not len(times):
+            return
+        order = np.argsort(times, kind="stable")
+        times, values = times[order], values[order]
+        first = 0
+        if self.size:
+            positions = (self.start + np.arange(self.size)) % self.capacity
+            first = int(np.searchsorted(self.times[positions], times[0], side="right"))
+            tail = positions[first:]
+            times = np.concatenate([self.times[tail], times])
+            values = np.concatenate([self.values[tail], values])
+            order = np.argsort(times, kind="stable")
+            times, values = times[order], values[order]
+        overflow = max(0, first + len(times) - self.capacity)
+        if overflow > first:
+            times, values = times[overflow - first:], values[overflow - first:]
+        positions = (self.start + first + np.arange(len(times))) % self.capacity
+        self.times[positions] = times
+        self.values[positions] = values
+        dropped = min(overflow, first)
+        self.start = (self.start + dropped) % self.capacity
+        self.size = first - dropped + len(times)
+
+    def range(self, start: float, end: float):
+        """Samples with start <= time < end, as (times, values) arrays."""
+        times, values = [], []
+        for segment in self._segments():
+            seg_times = self.times[segment]
+            lo, hi = np.searchsorted(seg_times, [start, end])
+            times.append(seg_times[lo:hi])
+            values.append(self.values[segment][lo:hi])
+        if not times:
+            return np.zeros(0), np.zeros(0, dtype=np.float32)
+        return np.concatenate(times), np.concatenate(values)
+
+
+class HeartRateStore:
+    """
+    Per-user heart-rate time series. Recent samples stay at full resolution
+    in a ring buffer per user, every sample is also folded into per-minute
+    and per-hour rollups (count, sum, min, max) persisted in SQLite.
+    Buffers of the max_users most recently written users are kept, older
+    ones are evicted and their history is answered from the rollups.
+    Rollup writes are committed together every commit_seconds or
+    commit_rows rows, and on flush.
+    """
+
+    def __init__(self, path: str, buffer_samples: int, max_users: int,
+                 commit_seconds: float, commit_rows: int):
+        self.buffer_samples = buffer_samples
+        self.max_users = max_users
+        self.commit_seconds = commit_seconds
+        self.commit_rows = commit_rows
+        self.buffers: Dict[str, RingBuffer] = OrderedDict()
+        self.evicted = 0
+        self.pending_rows = 0
+        self.last_commit = time.monotonic()
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS heart_rate_rollups ("
+            "user_id TEXT NOT NULL, resolution INTEGER NOT NULL, bucket INTEGER NOT NULL, "
+            "count INTEGER NOT NULL, sum REAL NOT NULL, min REAL NOT NULL, max REAL NOT NULL, "
+            "PRIMARY KEY (user_id, resolution, bucket)) WITHOUT ROWID"
+        )
+        self.db.commit()
+
+    def add(self, user_id: str, times, values):
+        """Records samples, times in unix seconds and values in BPM."""
+        times = np.asarray(times, dtype=np.float64)
+        values = np.asarray(values, dtype=np.float64)
+        if not len(times):
+            return
+        rows = []
+        for seconds in ROLLUP_SECONDS.values():
+            buckets, inverse = np.unique((times // seconds).astype(np.int64) * seconds, return_inverse=True)
+            counts = np.bincount(inverse)
+            sums = np.bincount(inverse, weights=values)
+            mins = np.full(len(buckets), np.inf)
+            maxs = np.full(len(buckets), -np.inf)
+            np.minimum.at(mins, inverse, values)
+            np.maximum.at(maxs, inverse, values)
+            rows += zip([user_id] * len(buckets), [seconds] * len(buckets), buckets.tolist(),
+                        counts.tolist(), sums.tolist(), mins.tolist(), maxs.tolist())
+        with self.lock:
+            buffer = self.buffers.get(user_id)
+            if buffer is None:
+                buffer = self.buffers[user_id] = RingBuffer(self.buffer_samples)
+                while len(self.buffers) > self.max_users:
+                    self.buffers.popitem(last=False)
+                    self.evicted += 1
+            else:
+                self.buffers.move_to_end(user_id)
+            buffer.extend(times, values.astype(np.float32))
+            self.db.executemany(
+                "INSERT INTO heart_rate_rollups (user_id, resolution, bucket, count, sum, min, max) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (user_id, resolution, bucket) DO UPDATE SET "
+                "count = count + excluded.count, sum = sum + excluded.sum, "
+                "min = MIN(min, excluded.min), max = MAX(max, excluded.max)",
+                rows,
+            )
+            self.pending_rows += len(rows)
+            if (self.pending_rows >= self.commit_rows
+                    or time.monotonic() - self.last_commit >= self.commit_seconds):
+                self._commit()
+
+    def _commit(self):
+        self.db.commit()
+        self.pending_rows = 0
+        self.last_commit = time.monotonic()
+
+    def flush(self):
+        """Commits the rollup writes still pending."""
+        with self.lock:
+            if self.pending_rows:
+                self._commit()
+
+    def pick_resolution(self, user_id: str, start: float, end: float) -> str:
+        """
+        Raw samples when the buffer holds everything since start,
+        otherwise the finest rollup that keeps the answer small.
+        """
+        with self.lock:
+            buffer = self.buffers.get(user_id)
+            if buffer is not None and buffer.size:
+                if buffer.oldest <= start:
+                    return "raw"
+                seconds = ROLLUP_SECONDS["minute"]
+                older = self.db.execute(
+                    "SELECT 1 FROM heart_rate_rollups WHERE user_id = ? AND resolution = ? "
+                    "AND bucket >= ? AND bucket < ? LIMIT 1",
+                    (user_id, seconds, int(start // seconds) * seconds, int(buffer.oldest // seconds) * seconds),
+                ).fetchone()
+                if older is None:
+                    return "raw"
+        return "minute" if end - start <= 2 * 86400 else "hour"
+
+    def query(self, user_id: str, start: float, end: float, resolution: str = "auto") -> Dict:
+        if resolution == "auto":
+            resolution = self.pick_resolution(user_id, start, end)
+        if resolution == "raw":
+            with self.lock:
+                buffer = self.buffers.get(user_id)
+                times, values = buffer.range(start, end) if buffer is not None else ([], [])
+            points: List[Dict] = [
+                {"t": t, "bpm": round(v, 2)} for t, v in zip(np.asarray(times).tolist(), np.asarray(values).tolist())
+            ]
+        else:
+            seconds = ROLLUP_SECONDS[resolution]
+            with self.lock:
+                rows = self.db.execute(
+                    "SELECT bucket, count, sum, min, max FROM heart_rate_rollups "
+                    "WHERE user_id = ? AND resolution = ? AND bucket >= ? AND bucket < ? ORDER BY bucket",
+                    (user_id, seconds, int(start // seconds) * seconds, end),
+                ).fetchall()
+            points = [
+                {"t": bucket, "count": count, "bpm": round(total / count, 2), "min": low, "max": high}
+                for bucket, count, total, low, high in rows
+            ]
+        return {"user_id": user_id, "resolution": resolution, "start": start, "end": end, "points": points}
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {
+                "users": len(self.buffers),
+                "max_users": self.max_users,
+                "evicted_users": self.evicted,
+                "pending_rows": self.pending_rows,
+                "buffered_samples": sum(buffer.size for buffer in self.buffers.values()),
+                "buffer_samples": self.buffer_samples,
+            }
+
+
+def create_heart_rate_store() -> HeartRateStore:
+    return HeartRateStore(
+        os.getenv("HEART_RATE_DB_PATH", "heart_rate.db"),
+        buffer_samples=int(os.getenv("HEART_RATE_BUFFER_SAMPLES", "7200")),
+        max_users=int(os.getenv("HEART_RATE_BUFFER_USERS", "1000")),
+        commit_seconds=float(os.getenv("HEART_RATE_COMMIT_SECONDS", "1")),
+        commit_rows=int(os.getenv("HEART_RATE_COMMIT_ROWS", "1000")),
+    )
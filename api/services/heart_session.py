@@ -0,0 +1,110 @@
+import os
+import time
+import math
+from typing import Optional, Tuple
+
+import numpy as np
+
+from process import absolute_times, retime, song_to_arrays, song_window, write_midi_bytes
+from services.audio_encoder import OutputFormat
+
+
+class HeartRateSession:
+    """
+    State of one live heart-rate session. Heart-rate samples are smoothed,
+    the music tempo follows the heart rate and leads it towards target_bpm
+    by at most lead_bpm, and the session song is rendered a few bars at a
+    time at the current tempo. Sound ringing past the end of a segment is
+    carried into the next one, and the segments go through one encoder for
+    the whole session, so they play back to back without gaps.
+    """
+
+    def __init__(self, song: dict, synthesizer, output: OutputFormat, target_bpm: float,
+                 lead_bpm: float, smoothing: float, min_change: float, segment_bars: int):
+        self.song = song_to_arrays(song)
+        self.synthesizer = synthesizer
+        self.output = output
+        self.target_bpm = target_bpm
+        self.lead_bpm = lead_bpm
+        self.smoothing = smoothing
+        self.min_change = min_change
+        beat = self.song['q']
+        numerator = 4
+        for evt in self.song.get('g', []):
+            if evt[0] == 's' and evt[1] == 0:
+                beat, numerator = self.song['q'] * 4 // evt[3], evt[2]
+        self.segment_beats = segment_bars * numerator
+        self.segment_ticks = self.segment_beats * beat
+        last_start = max((int(absolute_times(track['n']).max()) for track in self.song['t'] if len(track['n'])), default=0)
+        # The song loops, rounded up to whole segments
+        self.length = max(1, math.ceil((last_start + 1) / self.segment_ticks)) * self.segment_ticks
+        self.position = 0
+        self.carry = np.zeros(0, dtype=np.int32)
+        self.heart_rate: Optional[float] = None
+        self.tempo: Optional[float] = None
+        self.samples = 0
+        self.segments = 0
+        self.started_at: Optional[float] = None
+        self.buffered_seconds = 0.0
+
+    def add_sample(self, bpm: float) -> bool:
+        """Adds a heart-rate sample, True when the music tempo changed enough to report."""
+        self.samples += 1
+        if self.heart_rate is None:
+            self.heart_rate = bpm
+        else:
+            self.heart_rate += self.smoothing * (bpm - self.heart_rate)
+        step = max(-self.lead_bpm, min(self.lead_bpm, self.target_bpm - self.heart_rate))
+        tempo = round(min(200.0, max(20.0, self.heart_rate + step)), 1)
+        if self.tempo is None or abs(tempo - self.tempo) >= self.min_change:
+            self.tempo = tempo
+            return True
+        return False
+
+    def ahead_seconds(self) -> float:
+        """Seconds of audio sent but not played yet, assuming playback started on the first segment."""
+        if self.started_at is None:
+            return 0.0
+        return self.buffered_seconds - (time.monotonic() - self.started_at)
+
+    def render_segment(self) -> Tuple[bytes, float, float]:
+        """Renders the next segment at the current tempo, returns (pcm, seconds, tempo)."""
+        tempo = self.tempo
+        seconds = self.segment_beats * 60.0 / tempo
+        window = song_window(self.song, self.position, self.position + self.segment_ticks)
+        pcm = self.synthesizer.render(write_midi_bytes(retime(window, tempo)))
+        samples = np.frombuffer(pcm, dtype=np.int16).astype(np.int32)
+        size = round(seconds * self.synthesizer.sample_rate) * 2
+        mixed = np.zeros(max(size, len(samples), len(self.carry)), dtype=np.int32)
+        mixed[:len(samples)] += samples
+        mixed[:len(self.carry)] += self.carry
+        self.carry = mixed[size:]
+        segment = np.clip(mixed[:size], -32768, 32767).astype(np.int16).tobytes()
+        self.position = (self.position + self.segment_ticks) % self.length
+        self.segments += 1
+        if self.started_at is None:
+            self.started_at = time.monotonic()
+        self.buffered_seconds += seconds
+        return segment, seconds, tempo
+
+    def stats(self) -> dict:
+        return {
+            "heart_rate": round(self.heart_rate, 1) if self.heart_rate is not None else None,
+            "tempo": self.tempo,
+            "target_bpm": self.target_bpm,
+            "samples": self.samples,
+            "segments": self.segments,
+        }
+
+
+def create_session(song: dict, synthesizer, output: OutputFormat, target_bpm: float = None) -> HeartRateSession:
+    return HeartRateSession(
+        song,
+        synthesizer,
+        output,
+        target_bpm=target_bpm if target_bpm is not None else float(os.getenv("SESSION_TARGET_BPM", "60")),
+        lead_bpm=float(os.getenv("SESSION_LEAD_BPM", "5")),
+        smoothing=float(os.getenv("SESSION_SMOOTHING", "0.3")),
+        min_change=float(os.getenv("SESSION_MIN_TEMPO_CHANGE", "1")),
+        segment_bars=int(os.getenv("SESSION_SEGMENT_BARS", "2")),
+    )
@@ -0,0 +1,143 @@
+import time
+import uuid
+import asyncio
+import traceback
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+
+class QueueFullError(Exception):
+    pass
+
+
+@dataclass
+class Job:
+    id: str
+    filename: str
+    payload: object = None
+    status: str = "queued"  # queued, running, done or failed
+    result: Optional[Dict] = None
+    error: Optional[str] = None
+    created_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+    version: int = 0
+    changed: asyncio.Event = field(default_factory=asyncio.Event)
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "failed")
+
+    def update(self, **changes):
+        for key, value in changes.items():
+            setattr(self, key, value)
+        if self.finished:
+            self.finished_at = time.time()
+        self.version += 1
+        # Wake everyone waiting on this version, later waiters get a new event
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def wait_change(self, version: int, timeout: float):
+        """Waits until the job moves past version, or timeout seconds pass."""
+        if self.version != version:
+            return
+        try:
+            await asyncio.wait_for(self.changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def to_dict(self) -> Dict:
+        return {
+            "job_id": self.id,
+            "filename": self.filename,
+            "status": self.status,
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class JobQueue:
+    """
+    Bounded queue of background jobs processed by a fixed number of workers.
+    Finished jobs are kept for retention_seconds so clients can fetch results.
+    """
+
+    def __init__(self, handler: Callable[[object], Awaitable[Dict]], workers: int,
+                 max_queued: int, retention_seconds: float,
+                 discard: Callable[[object], None] = None):
+        self.handler = handler
+        self.discard = discard
+        self.worker_count = workers
+        self.retention_seconds = retention_seconds
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queued)
+        self.jobs: Dict[str, Job] = {}
+        self.workers: List[asyncio.Task] = []
+
+    def submit(self, filename: str, payload) -> Job:
+        self._expire()
+        job = Job(id=uuid.uuid4().hex, filename=filename, payload=payload)
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise QueueFullError("Too many audio files waiting for analysis, try again later")
+        self.jobs[job.id] = job
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self.jobs.get(job_id)
+
+    async def watch(self, job: Job, keepalive: float = 15) -> AsyncIterator[Optional[Job]]:
+        """Yields the job on every change until it finishes, None as a keep-alive."""
+        version = None
+        while True:
+            if job.version != version:
+                version = job.version
+                yield job
+                if job.finished:
+                    return
+            else:
+                yield None
+            await job.wait_change(version, keepalive)
+
+    async def _work(self):
+        while True:
+            job = await self.queue.get()
+            try:
+                job.update(status="running")
+                result = await self.handler(job.payload)
+                job.update(status="done", result=result, payload=None)
+            except Exception as e:
+                print(f"Job {job.id} failed: {e}")
+                print(traceback.format_exc())
+                job.update(status="failed", error=str(e) or type(e).__name__, payload=None)
+            finally:
+                self.queue.task_done()
+
+    def _expire(self):
+        cutoff = time.time() - self.retention_seconds
+        for job_id in [job_id for job_id, job in self.jobs.items()
+                       if job.finished and job.finished_at < cutoff]:
+            del self.jobs[job_id]
+
+    def start(self):
+        if not self.workers:
+            self.workers = [asyncio.create_task(self._work()) for _ in range(self.worker_count)]
+
+    async def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        # Release whatever is still waiting in the queue
+        while not self.queue.empty():
+            job = self.queue.get_nowait()
+            if self.discard is not None:
+                self.discard(job.payload)
+
+    def stats(self) -> Dict:
+        return {
+            "workers": self.worker_count,
+            "queued": self.queue.qsize(),
+            "running": sum(1 for job in self.jobs.values() if job.status == "running"),
+            "jobs": len(self.jobs),
+        }
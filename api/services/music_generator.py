@@ -1,32 +1,101 @@
 import os
+import io
 import json
-import google.generativeai as genai
-import tempfile
+import time
+import bisect
+import asyncio
+import traceback
+import datetime
+from google.generativeai import caching
+from typing import AsyncIterator, Optional, Tuple
+from services import gemini_client
+from services.audio_encoder import OutputFormat, create_output_format, encode, iter_bytes, stream_encode
+from services.executor import llm_executor, render_executor
+from services.music_pool import MusicPool, PooledTrack
+from services.note_scheduler import NoteScheduler
+from services.procedural_generator import CalmMarkovModel
+from services.render_cache import RenderCache, create_render_cache
+from services.synthesizer import NoteRenderer, create_synthesizer, midi_notes
+from process import NoteStreamParser, retime, tempo_ramp
+
+
+BACKENDS = ("gemini", "procedural")
+MUSIC_MODEL = "gemini-2.0-flash-thinking-exp-01-21"
 
 
 class MusicGeneratorService:
     def __init__(self):
         self.setup_gemini()
         self.load_examples()
+        self.setup_prompt()
+        self.setup_backend()
+        self.setup_pool()
+        self.synthesizer = create_synthesizer()
+        self.output = create_output_format(self.synthesizer.sample_rate)
+        self.render_cache = create_render_cache()
+        self.refill_task = None
+        self.prompt_cache_task = None
         
     def setup_gemini(self):
-        genai.configure(api_key=os.environ["GEMINI_API_KEY"])
+        gemini_client.configure()
         self.generation_config = {
             "max_output_tokens": 65536,
             "response_mime_type": "text/plain",
         }
         
+    def setup_prompt(self):
+        """Builds the static system prompt once, the request only sends the BPM."""
+        started = time.perf_counter()
+        self.system_prompt = self.build_system_prompt()
+        self.prompt_cache = None
+        # The fake LLM has no context caches
+        self.prompt_cache_enabled = (
+            os.getenv("MUSIC_PROMPT_CACHE", "true").lower() == "true" and not gemini_client.is_fake()
+        )
+        self.prompt_cache_ttl = datetime.timedelta(minutes=int(os.getenv("MUSIC_PROMPT_CACHE_TTL_MINUTES", "60")))
+        self.prompt_stats = {
+            "build_ms": round((time.perf_counter() - started) * 1000, 3),
+            "chars": len(self.system_prompt),
+            "tokens": None,
+            "cached": False,
+            "requests": 0,
+            "prompt_tokens": 0,
+            "cached_tokens": 0,
+            "output_tokens": 0,
+            "last_request": None,
+        }
+
+    def setup_backend(self):
+        self.backend = os.getenv("MUSIC_BACKEND", "gemini")
+        if self.backend not in BACKENDS:
+            raise ValueError(f"MUSIC_BACKEND must be one of {BACKENDS}")
+        # Fall back to procedural music when Gemini is slow or down
+        self.fallback = os.getenv("MUSIC_FALLBACK", "true").lower() == "true"
+        # How far the model must have written past a note before it is rendered
+        self.stream_margin_beats = float(os.getenv("MUSIC_STREAM_MARGIN_BEATS", "8"))
+        # Seconds of a complete song rendered per synth use when streaming
+        self.stream_window_seconds = float(os.getenv("MUSIC_STREAM_WINDOW_SECONDS", "5"))
+        self.procedural = CalmMarkovModel(self.example_songs)
+
+    def setup_pool(self):
+        depths = MusicPool.parse_buckets(
+            os.getenv("MUSIC_POOL_BUCKETS", "50,60,70,80,90,100,110,120"),
+            int(os.getenv("MUSIC_POOL_DEPTH", "1")),
+        )
+        self.pool = MusicPool(depths, float(os.getenv("MUSIC_POOL_TOLERANCE_BPM", "5")))
+
     def load_examples(self):
         # Load example JSON files
         def load_json_example(filename):
             with open(filename, 'r') as f:
-                return json.dumps(json.load(f), indent=2)
+                return json.load(f)
                 
-        self.example1 = load_json_example("calm.json")
-        self.example2 = load_json_example("calm2.json")
-        self.example3 = load_json_example("rivers.json")
+        self.example_songs = [load_json_example(name) for name in ("calm.json", "calm2.json", "rivers.json")]
+        self.example1, self.example2, self.example3 = (
+            json.dumps(song, separators=(',', ':')) for song in self.example_songs
+        )
         
-    def create_prompt(self, target_bpm):
+    def build_system_prompt(self):
         return f"""You are a MIDI music expert specializing in calm songs, relaxing music. Generate MIDI data following this exact structure for calming music, based on these three examples:
 
 Key structure points:
@@ -47,7 +116,7 @@ Key structure points:
 4. Structure:
 {{
     "q": 384,              // Ticks per beat - keep this exact value
-    "t": [{{                // Single track is fine for calm music
+    "t": [{{                // Exactly one track, every note goes in it
         "n": [             // Notes array with format [delta_time, note_number, velocity, duration]
             [0, 70, 50, 768],   // Example of a half note
             [0, 66, 50, 768],   // Simultaneous note (chord)
@@ -64,6 +133,7 @@ Key structure points:
 Important Rules:
 1. Always use string format for global events (g)
 2. Combine notes! make it good to listen! the examples have a good listening
+3. Write a single track, like the examples: the song is played while it is written, so a second track would come too late to play along
 
 
 Example 1, note the details:
@@ -78,46 +148,391 @@ Example 3, note the details:
 first analyze each song,give the same importance to each song, they are very good calm songs, use this examples as inspiration for the generated music, add your unique point for the generated song, make each generated song unique
 [MANDATORY]: follow the structure of the json """
         
-    async def generate_music(self, bpm: float) -> bytes:
+    def create_prompt(self, target_bpm):
+        """Per-request message, everything static lives in the system prompt."""
+        return f"generate a new calm music, based on the examples, but be creative!, combining elements from both while maintaining the peaceful atmosphere. give me the response in a json file, respect the structure, it is mandatory. note the details they are very important. think for long time. the song will be played at {round(target_bpm)} BPM."
+
+    def music_model(self):
+        if self.prompt_cache is not None:
+            return gemini_client.get_cached_model(self.prompt_cache, self.generation_config)
+        return gemini_client.get_model(MUSIC_MODEL, self.generation_config, self.system_prompt)
+
+    async def keep_prompt_cache(self):
+        """
+        Counts the system prompt tokens, registers it as a Gemini context cache
+        and keeps extending the cache TTL. Without a cache the prompt is sent inline.
+        """
+        try:
+            model = gemini_client.get_model(MUSIC_MODEL)
+            counted = await llm_executor.call(model.count_tokens_async, self.system_prompt)
+            self.prompt_stats["tokens"] = counted.total_tokens
+            print(f"Music system prompt: {counted.total_tokens} tokens, built in {self.prompt_stats['build_ms']} ms")
+        except Exception as e:
+            print(f"Could not count music prompt tokens: {e!r}")
+        if not self.prompt_cache_enabled:
+            return
+        while True:
+            try:
+                if self.prompt_cache is None:
+                    self.prompt_cache = await llm_executor.run(
+                        caching.CachedContent.create,
+                        model=MUSIC_MODEL,
+                        display_name="calm-music-prompt",
+                        system_instruction=self.system_prompt,
+                        ttl=self.prompt_cache_ttl,
+                    )
+                else:
+                    await llm_executor.run(self.prompt_cache.update, ttl=self.prompt_cache_ttl)
+                self.prompt_stats["cached"] = True
+            except Exception as e:
+                self.prompt_stats["cached"] = False
+                if self.prompt_cache is None:
+                    # The model or prompt size does not support caching
+                    print(f"Music prompt context cache unavailable, sending it inline: {e!r}")
+                    return
+                print(f"Could not extend music prompt cache, recreating it: {e!r}")
+                gemini_client.forget_cached_model(self.prompt_cache)
+                self.prompt_cache = None
+                continue
+            await asyncio.sleep(self.prompt_cache_ttl.total_seconds() / 2)
+
+    def record_usage(self, usage, build_ms: float):
+        """Keeps per-request and total token usage of the music model."""
+        last = {
+            "prompt_build_ms": build_ms,
+            "prompt_tokens": usage.prompt_token_count,
+            "cached_tokens": usage.cached_content_token_count,
+            "output_tokens": usage.candidates_token_count,
+        }
+        stats = self.prompt_stats
+        stats["requests"] += 1
+        stats["prompt_tokens"] += last["prompt_tokens"]
+        stats["cached_tokens"] += last["cached_tokens"]
+        stats["output_tokens"] += last["output_tokens"]
+        stats["last_request"] = last
+        print(f"Music generation tokens: {last}")
+
+    async def generate_song(self, bpm: float, backend: str = None) -> dict:
+        """Generates a song with the given backend, the service default if None."""
+        backend = backend or self.backend
+        if backend == "procedural":
+            return self.procedural.generate(bpm)
+        try:
+            return await self.generate_llm_song(bpm)
+        except Exception as e:
+            if not self.fallback:
+                raise
+            print(f"Gemini music generation failed, using procedural music: {e!r}")
+            return self.procedural.generate(bpm)
+
+    async def generate_llm_song(self, bpm: float, on_note=None) -> dict:
+        """
+        Streams the song from Gemini and parses it while it is written,
+        on_note(track, note, ticks_per_beat) is called for every completed note.
+        """
+        started = time.perf_counter()
         prompt = self.create_prompt(bpm)
+        model = self.music_model()
+        build_ms = round((time.perf_counter() - started) * 1000, 3)
+        return await llm_executor.call(self.stream_llm_song, model, prompt, bpm, build_ms, on_note)
 
-        model = genai.GenerativeModel(
-            model_name="gemini-2.0-flash-thinking-exp-01-21",
-            generation_config=self.generation_config,
-            system_instruction=prompt
-        )
-        
+    async def stream_llm_song(self, model, prompt: str, bpm: float, build_ms: float, on_note=None) -> dict:
         chat_session = model.start_chat()
-        response = chat_session.send_message("generate a new calm music, based on the examples, but be creative!, combining elements from both while maintaining the peaceful atmosphere. give me the response in a json file, respect the structure, it is mandatory. note the details they are very important. think for long time. ")
-        
-        # Clean and parse response
-        clean_json = response.text.replace("```json", "").replace("```", "").strip()
-        parsed_json = json.loads(clean_json)
-
-        # Create temporary files for JSON and MIDI
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False) as json_file:
-            json.dump(parsed_json, json_file, indent=2)
-            json_path = json_file.name
-            
-        with tempfile.NamedTemporaryFile(suffix='.mid', delete=False) as midi_file:
-            midi_path = midi_file.name
-        
+        response = await chat_session.send_message_async(prompt, stream=True)
+        parser = NoteStreamParser()
+        async for chunk in response:
+            notes = parser.feed("".join(part.text for part in chunk.parts))
+            if on_note is not None:
+                for track, note in notes:
+                    on_note(track, note, parser.q)
+        self.record_usage(response.usage_metadata, build_ms)
+
+        # The tempo is set locally instead of trusting the model with it
+        return retime(parser.song(), bpm)
+
+    def song_to_midi(self, song: dict) -> bytes:
+        midi_io = io.BytesIO()
+        self.text_to_midi(song, midi_io)
+        return midi_io.getvalue()
+
+    def render_audio(self, midi_data: bytes, output: OutputFormat) -> bytes:
+        """Renders MIDI bytes with the in-process synthesizer and encodes them to output."""
+        pcm = self.synthesizer.render(midi_data)
+        return encode(pcm, self.synthesizer.sample_rate, output)
+
+    def render_key(self, song: dict, output: OutputFormat) -> str:
+        key = RenderCache.key(song, self.synthesizer.soundfont, self.synthesizer.sample_rate, output.tag)
+        return f"{key}.{output.extension}"
+
+    def render_song(self, song: dict, output: OutputFormat = None) -> Tuple[str, bytes]:
+        """
+        Renders a song, or reads an earlier render of the same song and settings.
+        Returns the render cache key and the encoded audio.
+        """
+        output = output or self.output
+        key = self.render_key(song, output)
+        audio = self.render_cache.get(key)
+        if audio is None:
+            audio = self.render_audio(self.song_to_midi(song), output)
+            self.render_cache.put(key, audio)
+        return key, audio
+
+    async def build_track(self, bpm: float, backend: str = None, output: OutputFormat = None) -> PooledTrack:
+        """Generates and renders a complete track."""
+        song = await self.generate_song(bpm, backend)
+        key, audio = await render_executor.run(self.render_song, song, output)
+        return PooledTrack(bpm=bpm, song=song, audio=audio, key=key)
+
+    def take_pooled(self, bpm: float, backend: str = None):
+        """The pool only holds songs from the default backend."""
+        if backend not in (None, self.backend):
+            return None
+        return self.pool.take(bpm)
+
+    async def session_song(self, bpm: float) -> dict:
+        """Song for a live heart-rate session, pooled when available so it starts at once."""
+        track = self.take_pooled(bpm)
+        return track.song if track is not None else self.procedural.generate(bpm)
+
+    async def keep_addressable(self, track: PooledTrack):
+        # Pooled audio may have left the render cache while it waited in the pool
+        await render_executor.run(self.render_cache.put, track.key, track.audio)
+
+    async def get_track(self, bpm: float, ramp_to: float = None, ramp_bars: int = 8,
+                        backend: str = None, output: OutputFormat = None) -> PooledTrack:
+        """
+        Serves a pre-rendered track from the pool, falling back to
+        live generation when no bucket is close enough or it is empty.
+        With ramp_to the song tempo glides from bpm to ramp_to and is re-rendered.
+        Pooled songs are re-encoded when output differs from the default format.
+        """
+        output = output or self.output
+        track = self.take_pooled(bpm, backend)
+        if ramp_to is None:
+            if track is None:
+                return await self.build_track(bpm, backend, output)
+            if output == self.output:
+                await self.keep_addressable(track)
+                return track
+        song = track.song if track is not None else await self.generate_song(bpm, backend)
+        if ramp_to is not None:
+            song = tempo_ramp(song, bpm, ramp_to, ramp_bars)
+        key, audio = await render_executor.run(self.render_song, song, output)
+        return PooledTrack(bpm=ramp_to or bpm, song=song, audio=audio, key=key)
+
+    async def open_stream(self, bpm: float, ramp_to: float = None, ramp_bars: int = 8,
+                          backend: str = None, output: OutputFormat = None
+                          ) -> Tuple[AsyncIterator[bytes], Optional[str]]:
+        """
+        Returns an encoded chunk stream for the given BPM and the render cache
+        key it will be available under, None for songs still being generated.
+        Pooled tracks are sent in chunks, live tracks are rendered and encoded
+        progressively, so memory stays flat regardless of length.
+        """
+        output = output or self.output
+        track = self.take_pooled(bpm, backend)
+        if track is not None and ramp_to is None and output == self.output:
+            await self.keep_addressable(track)
+            return iter_bytes(track.audio), track.key
+        if track is None and ramp_to is None and (backend or self.backend) == "gemini":
+            return await self.open_live_stream(bpm, output), None
+        song = track.song if track is not None else await self.generate_song(bpm, backend)
+        if ramp_to is not None:
+            song = tempo_ramp(song, bpm, ramp_to, ramp_bars)
+        key = self.render_key(song, output)
+        audio = await render_executor.run(self.render_cache.get, key)
+        if audio is not None:
+            return iter_bytes(audio), key
+        pcm_chunks = self.render_song_chunks(self.song_to_midi(song))
+        return self.cache_stream(key, stream_encode(pcm_chunks, self.synthesizer.sample_rate, output)), key
+
+    async def render_song_chunks(self, midi_data: bytes) -> AsyncIterator[bytes]:
+        """Renders a complete song a window at a time on the render executor."""
+        notes, programs = await render_executor.run(midi_notes, midi_data)
+        renderer = NoteRenderer(self.synthesizer, programs)
+        starts = [note[0] for note in notes]
+        done = 0
+        until = self.stream_window_seconds
+        while True:
+            end = bisect.bisect_left(starts, until)
+            if end == len(notes):
+                # The last window ends with the tail of the song
+                yield await render_executor.run(renderer.render, notes[done:])
+                return
+            yield await render_executor.run(renderer.render, notes[done:end], until)
+            done = end
+            until += self.stream_window_seconds
+
+    async def cached_audio(self, key: str) -> Optional[bytes]:
+        """Encoded audio stored under a render cache key, None once it was evicted."""
+        return await render_executor.run(self.render_cache.get, key)
+
+    async def cache_stream(self, key: str, chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        """
+        Passes an encoded stream through, writing it to a file that joins the
+        render cache disk tier once the stream completed. Streams bigger than
+        the disk tier are not cached.
+        """
+        path = self.render_cache.temp_path(key)
+        file = await render_executor.run(open, path, "wb") if path is not None else None
+        written = 0
         try:
-            # Convert JSON to MIDI
-            self.text_to_midi(parsed_json, midi_path)
-            
-            # Read the MIDI file in binary mode
-            with open(midi_path, 'rb') as f:
-                midi_data = f.read()
-                
-            return midi_data
-            
+            async for chunk in chunks:
+                if file is not None:
+                    written += len(chunk)
+                    if written > self.render_cache.disk_bytes:
+                        await render_executor.run(file.close)
+                        await render_executor.run(os.remove, path)
+                        file = None
+                    else:
+                        await render_executor.run(file.write, chunk)
+                yield chunk
+            if file is not None:
+                await render_executor.run(file.close)
+                file = None
+                await render_executor.run(self.render_cache.put_file, key, path)
+        finally:
+            if file is not None:
+                # Incomplete, e.g. the client went away
+                file.close()
+                os.remove(path)
+
+    async def open_live_stream(self, bpm: float, output: OutputFormat) -> AsyncIterator[bytes]:
+        """
+        Streams a song while Gemini is still writing it. Notes are rendered as
+        soon as they are parsed and safe to play, so the first audio only waits
+        for the first bars. Returns once the first note arrived, errors before
+        that are raised here like for a complete generation.
+        """
+        batches = asyncio.Queue()
+        started = asyncio.get_running_loop().create_future()
+        task = asyncio.create_task(self.schedule_live_song(bpm, batches, started))
+        try:
+            await started
+        except BaseException:
+            task.cancel()
+            raise
+        return self.encode_live_stream(task, batches, output)
+
+    async def schedule_live_song(self, bpm: float, batches: asyncio.Queue, started: asyncio.Future):
+        """
+        Queues (notes, settled) batches of the song being generated for the
+        renderer, settled is the time no later note starts before. None ends it.
+        """
+        scheduler = None
+
+        def on_note(track, note, ticks_per_beat):
+            nonlocal scheduler
+            if scheduler is None:
+                scheduler = NoteScheduler(bpm, ticks_per_beat or 384, self.stream_margin_beats)
+                started.set_result(None)
+            scheduler.add(track, note)
+            notes = scheduler.ready()
+            if notes:
+                batches.put_nowait((notes, scheduler.settled))
+
+        try:
+            try:
+                await self.generate_llm_song(bpm, on_note)
+                if scheduler is None:
+                    raise ValueError("The generated song has no notes")
+            except Exception as e:
+                if scheduler is not None:
+                    # Part of the song is already playing, end it where the model stopped
+                    print(f"Gemini music stream stopped early: {e!r}")
+                elif self.fallback:
+                    print(f"Gemini music generation failed, using procedural music: {e!r}")
+                    song = self.procedural.generate(bpm)
+                    scheduler = NoteScheduler(bpm, song['q'], 0)
+                    for track, data in enumerate(song['t']):
+                        for note in data['n']:
+                            scheduler.add(track, note)
+                    started.set_result(None)
+                else:
+                    started.set_exception(e)
+                    return
+            batches.put_nowait((scheduler.flush(), None))
+            if scheduler.late:
+                print(f"Dropped {scheduler.late} streamed notes that arrived after their start was rendered, "
+                      f"the song has {len(scheduler.cursors)} tracks")
         finally:
-            # Cleanup temporary files
-            for path in [json_path, midi_path]:
-                if os.path.exists(path):
-                    os.remove(path)
-                    
+            batches.put_nowait(None)
+            if not started.done():
+                started.cancel()
+
+    async def render_live_chunks(self, batches: asyncio.Queue) -> AsyncIterator[bytes]:
+        """
+        Renders queued batches on the render executor as they come, merging
+        the batches that queued up while the previous one was rendered.
+        """
+        renderer = NoteRenderer(self.synthesizer)
+        finished = False
+        while not finished:
+            batch = await batches.get()
+            if batch is None:
+                break
+            notes, until = list(batch[0]), batch[1]
+            while until is not None and not batches.empty():
+                batch = batches.get_nowait()
+                if batch is None:
+                    finished = True
+                    break
+                notes += batch[0]
+                until = batch[1]
+            yield await render_executor.run(renderer.render, notes, until)
+        # The tail of the last notes, also when the stream ended early
+        yield await render_executor.run(renderer.render, [])
+
+    async def encode_live_stream(self, task: asyncio.Task, batches: asyncio.Queue,
+                                 output: OutputFormat) -> AsyncIterator[bytes]:
+        encoder = stream_encode(self.render_live_chunks(batches), self.synthesizer.sample_rate, output)
+        try:
+            async for chunk in encoder:
+                yield chunk
+        finally:
+            # Stop generating if the client went away mid-song
+            task.cancel()
+            await encoder.aclose()
+
+    async def refill_pool(self):
+        """Keeps every pool bucket filled up to its configured depth."""
+        while True:
+            bucket = self.pool.next_bucket()
+            if bucket is None:
+                self.pool.changed.clear()
+                await self.pool.changed.wait()
+                continue
+            try:
+                track = await self.build_track(bucket)
+                self.pool.put(bucket, track)
+            except Exception as e:
+                print(f"Error refilling music pool for {bucket} bpm: {e}")
+                print(traceback.format_exc())
+                await asyncio.sleep(30)
+
+    def start_background_tasks(self):
+        if self.prompt_cache_task is None and self.backend == "gemini":
+            self.prompt_cache_task = asyncio.create_task(self.keep_prompt_cache())
+        if self.refill_task is None and any(self.pool.depths.values()):
+            self.refill_task = asyncio.create_task(self.refill_pool())
+
+    async def stop_background_tasks(self):
+        for task in (self.refill_task, self.prompt_cache_task):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self.refill_task = self.prompt_cache_task = None
+        if self.prompt_cache is not None:
+            try:
+                await llm_executor.run(self.prompt_cache.delete)
+            except Exception as e:
+                print(f"Could not delete music prompt cache: {e!r}")
+            gemini_client.forget_cached_model(self.prompt_cache)
+            self.prompt_cache = None
+
     def text_to_midi(self, json_data, output_file):
         from process import text_to_midi
         text_to_midi(json_data, output_file)
\ No newline at end of file
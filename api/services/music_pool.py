@@ -0,0 +1,78 @@
+import asyncio
+from collections import deque
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+
+@dataclass
+class PooledTrack:
+    bpm: float
+    song: Dict
+    audio: bytes
+    key: Optional[str] = None  # render cache key of audio
+
+
+class MusicPool:
+    """
+    Warm pool of already rendered tracks, bucketed by target BPM.
+    A request is served from the bucket closest to its BPM, as long as it is
+    at most tolerance BPM away. Farther requests are misses.
+    """
+
+    def __init__(self, depths: Dict[int, int], tolerance: float):
+        self.depths = dict(sorted(depths.items()))
+        self.tolerance = tolerance
+        self.tracks: Dict[int, deque] = {bucket: deque() for bucket in self.depths}
+        self.hits = 0
+        self.misses = 0
+        self.changed = asyncio.Event()
+
+    @staticmethod
+    def parse_buckets(spec: str, default_depth: int) -> Dict[int, int]:
+        """Parses "60,70:2,80" into {60: default_depth, 70: 2, 80: default_depth}."""
+        depths = {}
+        for item in spec.split(","):
+            item = item.strip()
+            if not item:
+                continue
+            bpm, _, depth = item.partition(":")
+            depths[int(bpm)] = int(depth) if depth else default_depth
+        return depths
+
+    def bucket_for(self, bpm: float) -> Optional[int]:
+        if not self.depths:
+            return None
+        bucket = min(self.depths, key=lambda bucket: abs(bucket - bpm))
+        return bucket if abs(bucket - bpm) <= self.tolerance else None
+
+    def take(self, bpm: float) -> Optional[PooledTrack]:
+        bucket = self.bucket_for(bpm)
+        if bucket is None or not self.tracks[bucket]:
+            self.misses += 1
+            return None
+        self.hits += 1
+        track = self.tracks[bucket].popleft()
+        self.changed.set()
+        return track
+
+    def put(self, bucket: int, track: PooledTrack):
+        self.tracks[bucket].append(track)
+
+    def next_bucket(self) -> Optional[int]:
+        """Returns the emptiest bucket still below its depth, if any."""
+        pending = [b for b, depth in self.depths.items() if len(self.tracks[b]) < depth]
+        if not pending:
+            return None
+        return min(pending, key=lambda b: len(self.tracks[b]) / self.depths[b])
+
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "buckets": {
+                str(bucket): {"available": len(self.tracks[bucket]), "depth": depth}
+                for bucket, depth in self.depths.items()
+            },
+        }
@@ -0,0 +1,61 @@
+import heapq
+from typing import Dict, List, Tuple
+
+# (start seconds, end seconds, channel, note, velocity)
+SynthNote = Tuple[float, float, int, int, int]
+
+
+class NoteScheduler:
+    """
+    Turns notes streamed in the compact [delta, note, vel, dur(, channel)] format
+    into time-sorted synth notes at a constant tempo.
+    A negative delta can start a note before notes already received, so notes
+    are only released once every track has streamed margin_beats past them.
+    """
+
+    def __init__(self, bpm: float, ticks_per_beat: int, margin_beats: float):
+        self.seconds_per_tick = 60.0 / (bpm * ticks_per_beat)
+        self.margin = margin_beats * ticks_per_beat
+        self.cursors: Dict[int, int] = {}
+        self.heap: List[Tuple[int, int, int, int, int, int]] = []
+        self.order = 0
+        self.played = 0
+        self.late = 0
+
+    @property
+    def settled(self) -> float:
+        """Seconds before which no note can start anymore, audio up to there is final."""
+        return self.played * self.seconds_per_tick
+
+    def add(self, track: int, note: List[int]):
+        delta, pitch, velocity, duration = note[:4]
+        channel = note[4] if len(note) > 4 else 0
+        start = self.cursors.get(track, 0) + delta
+        self.cursors[track] = start
+        if velocity <= 0 or duration <= 0:
+            return
+        if start < self.played:
+            # Arrived after its start was rendered, e.g. a second track
+            self.late += 1
+            return
+        heapq.heappush(self.heap, (start, self.order, channel, pitch, velocity, duration))
+        self.order += 1
+
+    def _release(self, horizon: float) -> List[SynthNote]:
+        notes = []
+        while self.heap and self.heap[0][0] <= horizon:
+            start, _, channel, pitch, velocity, duration = heapq.heappop(self.heap)
+            self.played = start
+            notes.append((start * self.seconds_per_tick, (start + duration) * self.seconds_per_tick,
+                          channel, pitch, velocity))
+        return notes
+
+    def ready(self) -> List[SynthNote]:
+        """Notes that no note still to come can precede."""
+        if not self.cursors:
+            return []
+        return self._release(min(self.cursors.values()) - self.margin)
+
+    def flush(self) -> List[SynthNote]:
+        """Every remaining note, once the song is complete."""
+        return self._release(float("inf"))
@@ -0,0 +1,101 @@
+import random
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from process import retime
+
+# Token: (delta, interval from previous pitch, duration), quantized to GRID ticks
+Token = Tuple[int, int, int]
+
+
+class CalmMarkovModel:
+    """
+    Order-2 Markov model over delta/interval/duration patterns of the example songs.
+    Generates new songs in the compact [delta, note, vel, dur] format locally,
+    in milliseconds, without calling the LLM.
+    """
+
+    PPQ = 384
+    GRID = 96  # sixteenth note at 384 ticks per beat
+
+    def __init__(self, examples: List[Dict], variety: float = 0.25, seed: Optional[int] = None):
+        # variety: chance of following the shorter order-1 context, which mixes the examples
+        self.variety = variety
+        self.random = random.Random(seed)
+        self.transitions: Dict[Tuple[Token, Token], Counter] = defaultdict(Counter)
+        self.followers: Dict[Token, Counter] = defaultdict(Counter)
+        self.starts: List[Tuple[int, Token, Token]] = []
+        self.velocities: List[int] = []
+        pitches = []
+        for song in examples:
+            scale = self.PPQ / song['q']
+            for track in song['t']:
+                notes = [note for note in track['n'] if len(note) < 5 or note[4] != 9]
+                if len(notes) < 3:
+                    continue
+                tokens = []
+                prev = notes[0][1]
+                for delta, pitch, vel, dur, *_ in notes:
+                    tokens.append((self._quantize(delta * scale), pitch - prev, max(self.GRID, self._quantize(dur * scale))))
+                    prev = pitch
+                    pitches.append(pitch)
+                    self.velocities.append(vel)
+                self.starts.append((notes[0][1], tokens[0], tokens[1]))
+                for a, b, c in zip(tokens, tokens[1:], tokens[2:]):
+                    self.transitions[(a, b)][c] += 1
+                for a, b in zip(tokens, tokens[1:]):
+                    self.followers[a][b] += 1
+        if not self.starts:
+            raise ValueError("Procedural music needs at least one example with 3 or more notes")
+        self.low, self.high = min(pitches), max(pitches)
+
+    def _quantize(self, ticks: float) -> int:
+        return int(round(ticks / self.GRID)) * self.GRID
+
+    def _sample(self, counter: Counter):
+        tokens, weights = zip(*counter.items())
+        return self.random.choices(tokens, weights)[0]
+
+    def _next(self, a: Token, b: Token) -> Token:
+        if (a, b) in self.transitions and self.random.random() >= self.variety:
+            return self._sample(self.transitions[(a, b)])
+        if b in self.followers:
+            return self._sample(self.followers[b])
+        # Dead end, jump back to the start of a random example
+        return self.random.choice(self.starts)[1]
+
+    def _fold(self, pitch: int) -> int:
+        while pitch > self.high:
+            pitch -= 12
+        while pitch < self.low:
+            pitch += 12
+        return pitch
+
+    def generate(self, bpm: float, bars: int = 32, max_notes: int = 2000) -> Dict:
+        """Generates a new single-track song of about bars 4/4 bars at bpm."""
+        pitch, prev, token = self.random.choice(self.starts)
+        velocity = self.random.choice(self.velocities)
+        end = bars * 4 * self.PPQ
+        pitch = self._fold(pitch)
+        notes = [[0, pitch, velocity, prev[2]]]
+        same_pitch = defaultdict(list, {pitch: [(notes[0], 0)]})
+        abs_time = last = 0
+        while abs_time < end and len(notes) < max_notes:
+            delta, interval, dur = token
+            prev, token = token, self._next(prev, token)
+            abs_time = max(0, abs_time + delta)
+            pitch = self._fold(pitch + interval)
+            # Same-pitch notes must not overlap: skip exact repeats, shorten the earlier note
+            if any(start == abs_time for _, start in same_pitch[pitch]):
+                continue
+            for held, start in same_pitch[pitch]:
+                if start < abs_time < start + held[3]:
+                    held[3] = abs_time - start
+                elif abs_time < start < abs_time + dur:
+                    dur = start - abs_time
+            note = [abs_time - last, pitch, velocity, dur]
+            notes.append(note)
+            same_pitch[pitch].append((note, abs_time))
+            last = abs_time
+        song = {'q': self.PPQ, 't': [{'n': notes}], 'g': [['s', 0, 4, 4]]}
+        return retime(song, bpm)
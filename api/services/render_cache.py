@@ -0,0 +1,173 @@
+import os
+import uuid
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from process import midi_globals, song_to_bytes
+
+
+class RenderCache:
+    """
+    Two-tier cache of rendered audio. Recent renders stay in an in-memory LRU
+    bounded by memory_bytes, evicted ones spill to files in directory,
+    bounded by disk_bytes. A budget of 0 disables that tier.
+    """
+
+    def __init__(self, directory: str, memory_bytes: int, disk_bytes: int):
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.memory: OrderedDict = OrderedDict()
+        self.memory_used = 0
+        self.disk: OrderedDict = OrderedDict()
+        self.disk_used = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if disk_bytes > 0:
+            os.makedirs(directory, exist_ok=True)
+            # Oldest files first, so they are the first to be evicted
+            files = sorted(os.scandir(directory), key=lambda entry: entry.stat().st_mtime)
+            for entry in files:
+                if entry.name.endswith(".tmp"):
+                    os.remove(entry.path)
+                else:
+                    self.disk[entry.name] = entry.stat().st_size
+                    self.disk_used += self.disk[entry.name]
+
+    @staticmethod
+    def key(song: Dict, soundfont: str, sample_rate: int, output: str) -> str:
+        """
+        Hash of the canonical song data and everything that changes the rendered
+        audio, output describes the encoder settings (codec, bitrate, ...).
+        Global events count as the MIDI messages they are written as, so events
+        the MIDI writer skips never fail the key.
+        """
+        notes = {field: value for field, value in song.items() if field != 'g'}
+        digest = hashlib.sha256(song_to_bytes(notes))
+        for tick, message in midi_globals(song.get('g', [])):
+            digest.update(tick.to_bytes(4, "little") + message)
+        try:
+            stat = os.stat(soundfont)
+            soundfont = f"{soundfont}:{stat.st_size}:{stat.st_mtime_ns}"
+        except OSError:
+            pass
+        digest.update(f"|{soundfont}|{sample_rate}|{output}".encode())
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+                return self.memory[key]
+            on_disk = key in self.disk
+            if not on_disk:
+                self.misses += 1
+                return None
+            self.disk.move_to_end(key)
+        try:
+            with open(self._path(key), "rb") as f:
+                data = f.read()
+            os.utime(self._path(key))
+        except OSError:
+            with self.lock:
+                self.disk_used -= self.disk.pop(key, 0)
+                self.misses += 1
+            return None
+        with self.lock:
+            self.disk_hits += 1
+        self.put(key, data)
+        return data
+
+    def put(self, key: str, data: bytes):
+        spilled = []
+        with self.lock:
+            if key in self.memory:
+                self.memory_used -= len(self.memory.pop(key))
+            if len(data) <= self.memory_bytes:
+                self.memory[key] = data
+                self.memory_used += len(data)
+            else:
+                spilled.append((key, data))
+            while self.memory_used > self.memory_bytes:
+                oldest, evicted = self.memory.popitem(last=False)
+                self.memory_used -= len(evicted)
+                spilled.append((oldest, evicted))
+        for spill_key, spill_data in spilled:
+            self._spill(spill_key, spill_data)
+
+    def _spill(self, key: str, data: bytes):
+        if len(data) > self.disk_bytes:
+            return
+        with self.lock:
+            if key in self.disk:
+                self.disk.move_to_end(key)
+                return
+        tmp = self.temp_path(key)
+        try:
+            with open(tmp, "wb") as f:
+                f.write(data)
+        except OSError as e:
+            print(f"Could not write render cache file: {e}")
+            return
+        self.put_file(key, tmp)
+
+    def temp_path(self, key: str) -> Optional[str]:
+        """A new file to write an entry to before put_file, None when the disk tier is disabled."""
+        if self.disk_bytes <= 0:
+            return None
+        return self._path(f"{key}.{uuid.uuid4().hex}.tmp")
+
+    def put_file(self, key: str, tmp: str):
+        """Moves a completely written temp_path file into the disk tier."""
+        try:
+            size = os.path.getsize(tmp)
+            if size > self.disk_bytes:
+                os.remove(tmp)
+                return
+            os.replace(tmp, self._path(key))
+        except OSError as e:
+            print(f"Could not write render cache file: {e}")
+            return
+        removed = []
+        with self.lock:
+            self.disk_used += size - self.disk.pop(key, 0)
+            self.disk[key] = size
+            while self.disk_used > self.disk_bytes:
+                oldest, size = self.disk.popitem(last=False)
+                self.disk_used -= size
+                removed.append(oldest)
+        for oldest in removed:
+            try:
+                os.remove(self._path(oldest))
+            except OSError:
+                pass
+
+    def stats(self) -> Dict:
+        hits = self.memory_hits + self.disk_hits
+        total = hits + self.misses
+        return {
+            "memory_entries": len(self.memory),
+            "memory_bytes": self.memory_used,
+            "disk_entries": len(self.disk),
+            "disk_bytes": self.disk_used,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": hits / total if total else 0.0,
+        }
+
+
+def create_render_cache() -> RenderCache:
+    return RenderCache(
+        directory=os.getenv("RENDER_CACHE_DIR", "render_cache"),
+        memory_bytes=int(float(os.getenv("RENDER_CACHE_MEMORY_MB", "256")) * 1024 * 1024),
+        disk_bytes=int(float(os.getenv("RENDER_CACHE_DISK_MB", "2048")) * 1024 * 1024),
+    )
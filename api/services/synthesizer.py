@@ -0,0 +1,185 @@
+import io
+import os
+import queue
+import threading
+from collections import deque
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import fluidsynth
+import mido
+import numpy as np
+
+from services.executor import render_executor
+from services.note_scheduler import SynthNote
+
+
+class MidiSynthesizer:
+    """
+    Long-lived in-process MIDI renderer.
+    Soundfonts are loaded once per synth and reused for every render,
+    MIDI bytes are rendered straight to 16-bit interleaved stereo PCM.
+    """
+
+    def __init__(self, soundfont: str, sample_rate: int = 44100, synths: int = 1,
+                 chunk_frames: int = 4096, tail_seconds: float = 1.5):
+        self.soundfont = soundfont
+        self.sample_rate = sample_rate
+        self.chunk_frames = chunk_frames
+        self.tail_seconds = tail_seconds
+        self.size = synths
+        self.idle = queue.Queue()
+        self.created = 0
+        self.lock = threading.Lock()
+
+    def _acquire(self):
+        # Synths are created lazily, the soundfont load happens once per synth
+        with self.lock:
+            if self.idle.empty() and self.created < self.size:
+                self.created += 1
+                synth = fluidsynth.Synth(samplerate=float(self.sample_rate))
+                return synth, synth.sfload(self.soundfont)
+        return self.idle.get()
+
+    def _release(self, synth, sfid: int):
+        self.idle.put((synth, sfid))
+
+    def _reset(self, synth, sfid: int, programs: Dict[int, int] = None):
+        for channel in range(16):
+            synth.cc(channel, 120, 0)  # all sound off
+            synth.cc(channel, 121, 0)  # reset controllers
+            program = (programs or {}).get(channel, 0)
+            synth.program_select(channel, sfid, 128 if channel == 9 else 0, program)
+
+    def _samples(self, synth, frames: int) -> Iterator[bytes]:
+        while frames > 0:
+            n = min(frames, self.chunk_frames)
+            yield synth.get_samples(n).tobytes()
+            frames -= n
+
+    def iter_render(self, midi_data: bytes) -> Iterator[bytes]:
+        """Renders MIDI bytes, yielding PCM chunks of at most chunk_frames frames."""
+        midi = mido.MidiFile(file=io.BytesIO(midi_data))
+        synth, sfid = self._acquire()
+        try:
+            self._reset(synth, sfid)
+            elapsed = 0.0
+            rendered = 0
+            for msg in midi:
+                elapsed += msg.time
+                target = round(elapsed * self.sample_rate)
+                if target > rendered:
+                    yield from self._samples(synth, target - rendered)
+                    rendered = target
+                if msg.type == 'note_on' and msg.velocity > 0:
+                    synth.noteon(msg.channel, msg.note, msg.velocity)
+                elif msg.type in ('note_on', 'note_off'):
+                    synth.noteoff(msg.channel, msg.note)
+                elif msg.type == 'program_change':
+                    synth.program_change(msg.channel, msg.program)
+                elif msg.type == 'control_change':
+                    synth.cc(msg.channel, msg.control, msg.value)
+                elif msg.type == 'pitchwheel':
+                    synth.pitch_bend(msg.channel, msg.pitch)
+            # Let the last notes ring out
+            yield from self._samples(synth, round(self.tail_seconds * self.sample_rate))
+        finally:
+            self._release(synth, sfid)
+
+    def render(self, midi_data: bytes) -> bytes:
+        """Renders MIDI bytes to a single PCM buffer."""
+        return b"".join(self.iter_render(midi_data))
+
+
+def midi_notes(midi_data: bytes) -> Tuple[List[SynthNote], Dict[int, int]]:
+    """The notes of MIDI bytes sorted by start, and the program of each channel."""
+    notes = []
+    programs = {}
+    sounding: Dict[Tuple[int, int], deque] = {}
+    elapsed = 0.0
+    for msg in mido.MidiFile(file=io.BytesIO(midi_data)):
+        elapsed += msg.time
+        if msg.type == 'note_on' and msg.velocity > 0:
+            sounding.setdefault((msg.channel, msg.note), deque()).append((elapsed, msg.velocity))
+        elif msg.type in ('note_on', 'note_off'):
+            started = sounding.get((msg.channel, msg.note))
+            if started:
+                start, velocity = started.popleft()
+                notes.append((start, elapsed, msg.channel, msg.note, velocity))
+        elif msg.type == 'program_change':
+            programs.setdefault(msg.channel, msg.program)
+    for (channel, note), started in sounding.items():
+        notes.extend((start, elapsed, channel, note, velocity) for start, velocity in started)
+    notes.sort()
+    return notes, programs
+
+
+class NoteRenderer:
+    """
+    Renders a song that arrives as batches of notes in start order. Each batch
+    takes a synth from the pool only while it is rendered, on a reset synth,
+    and the sound ringing past the batch is mixed into the next ones, so a
+    slow producer (a model still writing the song, a slow client) never keeps
+    a synth busy.
+    """
+
+    def __init__(self, synthesizer: MidiSynthesizer, programs: Dict[int, int] = None):
+        self.synthesizer = synthesizer
+        self.programs = programs or {}
+        self.pending = np.zeros(0, dtype=np.int32)  # interleaved stereo samples from emitted on
+        self.emitted = 0  # frames already returned
+
+    def render(self, notes: List[SynthNote], until: Optional[float] = None) -> bytes:
+        """
+        Renders a batch of notes, none may start before the until of the
+        previous batch. Returns the PCM up to until seconds, which later
+        notes must not start before, or all of it, tail included, when None.
+        """
+        synthesizer = self.synthesizer
+        if notes:
+            events = []
+            for start, end, channel, note, velocity in notes:
+                events.append((start, 1, channel, note, velocity))
+                events.append((end, 0, channel, note, 0))
+            # Releases sort before attacks at the same time
+            events.sort()
+            rendered = self.emitted
+            chunks = []
+            synth, sfid = synthesizer._acquire()
+            try:
+                synthesizer._reset(synth, sfid, self.programs)
+                for seconds, _, channel, note, velocity in events:
+                    target = max(rendered, round(seconds * synthesizer.sample_rate))
+                    if target > rendered:
+                        chunks.extend(synthesizer._samples(synth, target - rendered))
+                        rendered = target
+                    if velocity > 0:
+                        synth.noteon(channel, note, velocity)
+                    else:
+                        synth.noteoff(channel, note)
+                chunks.extend(synthesizer._samples(synth, round(synthesizer.tail_seconds * synthesizer.sample_rate)))
+            finally:
+                synthesizer._release(synth, sfid)
+            pcm = np.frombuffer(b"".join(chunks), dtype=np.int16)
+            if len(pcm) > len(self.pending):
+                self.pending = np.concatenate([self.pending, np.zeros(len(pcm) - len(self.pending), dtype=np.int32)])
+            self.pending[:len(pcm)] += pcm
+        if until is None:
+            size = len(self.pending)
+        else:
+            size = max(0, round(until * synthesizer.sample_rate) - self.emitted) * 2
+            if size > len(self.pending):
+                # Silence until the next note
+                self.pending = np.concatenate([self.pending, np.zeros(size - len(self.pending), dtype=np.int32)])
+        out = np.clip(self.pending[:size], -32768, 32767).astype(np.int16).tobytes()
+        self.pending = self.pending[size:]
+        self.emitted += size // 2
+        return out
+
+
+def create_synthesizer() -> MidiSynthesizer:
+    return MidiSynthesizer(
+        soundfont=os.getenv("SOUNDFONT_PATH", "/usr/share/sounds/sf2/FluidR3_GM.sf2"),
+        sample_rate=int(os.getenv("RENDER_SAMPLE_RATE", "44100")),
+        # One synth per render thread, so a render never waits for a synth
+        synths=int(os.getenv("RENDER_SYNTHS", str(render_executor.max_concurrency))),
+    )